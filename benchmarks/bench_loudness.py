@@ -0,0 +1,86 @@
+"""
+Benchmark of the loudness analysis on a synthetic song library.
+
+Compares the block-wise vectorized analysis of :func:`philipplay.loudness.analyze` with a
+plain per-sample Python loop. The songs are generated in memory as 16 bit stereo samples,
+so neither the USB stick nor the decoder is part of the measurement.
+
+    python benchmarks/bench_loudness.py --songs 10 --seconds 180
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from philipplay.loudness import analyze  # noqa: E402
+
+SAMPLE_RATE = 44100
+
+
+def synthetic_song(seconds, level, seed):
+    """Generates a song of noise and a sine tone at the given RMS level, 16 bit stereo"""
+    random = numpy.random.RandomState(seed)
+    count = int(seconds * SAMPLE_RATE)
+    tone = numpy.sin(numpy.arange(count) * (2 * numpy.pi * (220 + seed * 55) / SAMPLE_RATE))
+    signal = .7 * tone + .3 * random.standard_normal(count)
+    signal *= level / numpy.sqrt(numpy.mean(signal ** 2))
+    samples = numpy.clip(signal * 32767, -32768, 32767).astype(numpy.int16)
+    return numpy.column_stack((samples, samples))
+
+
+def analyze_loop(samples, target=.1, max_gain=4.):
+    """Reference implementation iterating over every single sample in Python"""
+    full_scale = 32767.
+    squares = 0.
+    peak = 0.
+    values = samples.reshape(-1).tolist()
+    for value in values:
+        squares += value * value
+        peak = max(peak, abs(value))
+    rms = (squares / len(values)) ** .5 / full_scale
+    peak /= full_scale
+    return min(target / rms, max_gain, 1. / peak), rms, peak
+
+
+def measure(function, songs):
+    """Runs the analysis on all songs and returns the elapsed time and the gains"""
+    start = time.perf_counter()
+    gains = [function(song)[0] for song in songs]
+    return time.perf_counter() - start, gains
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the loudness analysis')
+    parser.add_argument('--songs', type=int, default=10, help='number of songs in the library')
+    parser.add_argument('--seconds', type=float, default=180, help='length of every song')
+    parser.add_argument('--loop-seconds', type=float, default=10,
+                        help='length of the songs analyzed by the per-sample loop, which is very slow')
+    args = parser.parse_args()
+
+    levels = numpy.linspace(.02, .3, args.songs)
+    songs = [synthetic_song(args.seconds, level, seed) for seed, level in enumerate(levels)]
+    audio_seconds = args.songs * args.seconds
+
+    elapsed, gains = measure(analyze, songs)
+    print('vectorized: %.3f s for %.0f s of audio, %.0fx realtime' % (elapsed, audio_seconds, audio_seconds / elapsed))
+    for level, gain in zip(levels, gains):
+        print('  level %.3f -> gain %.2f' % (level, gain))
+
+    loop_songs = [song[:int(args.loop_seconds * SAMPLE_RATE)] for song in songs]
+    loop_seconds = args.songs * args.loop_seconds
+    loop_elapsed, loop_gains = measure(analyze_loop, loop_songs)
+    vector_elapsed, vector_gains = measure(analyze, loop_songs)
+    print('per-sample: %.3f s for %.0f s of audio, %.0fx realtime' % (
+        loop_elapsed, loop_seconds, loop_seconds / loop_elapsed))
+    print('speedup: %.0fx' % (loop_elapsed / vector_elapsed))
+
+    deviation = max(abs(a - b) for a, b in zip(loop_gains, vector_gains))
+    print('max gain deviation: %.6f' % deviation)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+"""
+Memory benchmark of the song library on a large synthetic song library.
+
+A song library of empty song files is generated (see :mod:`synthetic`), scanned once cold
+and once from the library index, and the memory held by the library afterwards is measured
+with :mod:`tracemalloc`. A plain list of the absolute song paths is measured for comparison.
+
+    python benchmarks/bench_memory.py --folders 500 --files 100
+"""
+import argparse
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import synthetic  # noqa: E402
+from philipplay.library import Library  # noqa: E402
+
+
+def measure(create):
+    """
+    Measures the memory held by the object created by a function.
+
+    :return: Tuple of the object, the bytes it holds and the peak bytes while it was created
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = create()
+        gc.collect()
+        current, peak = tracemalloc.get_traced_memory()
+        statistics = tracemalloc.take_snapshot().statistics('filename')
+    finally:
+        tracemalloc.stop()
+    return result, current, peak, statistics
+
+
+def scan(base_path, index_path):
+    library = Library(base_path=base_path, index_path=index_path, rescan_debounce_ms=0)
+    library._rescan_library()
+    return library
+
+
+def report(name, songs, current, peak, statistics=None):
+    print('%-22s %8.1f MiB held (%6.1f bytes per song), %8.1f MiB peak' % (
+        name, current / 2 ** 20, current / songs, peak / 2 ** 20))
+    package = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for statistic in statistics or ():
+        path = statistic.traceback[0].filename
+        if statistic.size > current / 100:
+            print('    %-40s %8.1f MiB' % (os.path.relpath(path, package) if path.startswith(package) else
+                                         os.path.basename(path), statistic.size / 2 ** 20))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='measure the memory held by the song library')
+    parser.add_argument('--folders', type=int, default=500, help='number of song directories')
+    parser.add_argument('--files', type=int, default=100, help='number of songs per directory')
+    args = parser.parse_args()
+
+    work_path = tempfile.mkdtemp(prefix='philipplay-memory-')
+    try:
+        base_path = os.path.join(work_path, 'library')
+        index_path = os.path.join(work_path, 'index.json')
+        directories = synthetic.generate(base_path, args.folders, args.files, seconds=0, extensions=('.ogg',))
+        # the index only stores directories older than the racy window of FAT file systems
+        for directory in directories:
+            os.utime(directory, (0, 0))
+        songs = args.folders * args.files
+        print('%s songs in %s directories' % (songs, args.folders))
+
+        paths, current, peak, _ = measure(lambda: [
+            os.path.join(directory, entry.name) for directory in directories for entry in os.scandir(directory)])
+        report('list of paths', songs, current, peak)
+        del paths
+
+        library, current, peak, statistics = measure(lambda: scan(base_path, index_path))
+        report('library, cold scan', songs, current, peak, statistics)
+        del library
+
+        library, current, peak, statistics = measure(lambda: scan(base_path, index_path))
+        report('library, warm scan', songs, current, peak, statistics)
+        del library
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
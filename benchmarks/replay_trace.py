@@ -0,0 +1,381 @@
+"""
+Replays a trace recorded with ``philipplay --record-trace`` (see :mod:`philipplay.trace`) and
+reports the time to handle every recorded key press, file system event and end event of the mixer.
+
+The song library of the trace is rebuilt in a temporary directory from synthetic songs (see
+:mod:`synthetic`), the recorded changes of the file system are applied to it before their event
+is handed to the library. The mixer is replaced by a null mixer which plays nothing, songs only
+end when the trace says so. The library is not started, so no file system observer is running,
+and the events are applied right away instead of being coalesced. The work the library and the
+mixer hand over to the controller is done before the next record is replayed and is included in
+the time of the record.
+
+The transitions of the player during the replay are compared against the recorded ones, to tell
+whether the replay took the same path as the recording:
+
+    python benchmarks/replay_trace.py field.trace
+    python benchmarks/replay_trace.py field.trace --realtime
+    python benchmarks/replay_trace.py field.trace --output after.json --baseline before.json
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from watchdog.events import DirCreatedEvent, DirDeletedEvent, DirModifiedEvent, DirMovedEvent, \
+    FileCreatedEvent, FileDeletedEvent, FileModifiedEvent, FileMovedEvent  # noqa: E402
+
+import synthetic  # noqa: E402
+from philipplay import player as player_module  # noqa: E402
+from philipplay.controller import Controller  # noqa: E402
+from philipplay.library import Library  # noqa: E402
+from philipplay.player import NEXT_SONG, STOP, PLAYING, FADING, Player  # noqa: E402
+from philipplay.trace import EVENT, KEYS, LIBRARY, LISTING, MIXER, PLAYER, TraceRecorder, read_trace  # noqa: E402
+from suite import compare, describe  # noqa: E402
+
+EVENT_CLASSES = {
+    ('created', False): FileCreatedEvent, ('created', True): DirCreatedEvent,
+    ('deleted', False): FileDeletedEvent, ('deleted', True): DirDeletedEvent,
+    ('modified', False): FileModifiedEvent, ('modified', True): DirModifiedEvent,
+    ('moved', False): FileMovedEvent, ('moved', True): DirMovedEvent,
+}
+
+KIND_NAMES = {KEYS: 'keys', EVENT: 'event', LISTING: 'event', MIXER: 'mixer'}
+
+
+class NullMusic(object):
+    """Stands in for :mod:`pygame.mixer.music`, nothing is played and no end event is posted"""
+    def __init__(self):
+        self._busy = False
+
+    def load(self, source, namehint=None):
+        if not isinstance(source, str):
+            source.close()
+
+    def play(self, loops=0, start=0.):
+        self._busy = True
+
+    def queue(self, source, namehint=None):
+        self.load(source, namehint)
+
+    def stop(self):
+        self._busy = False
+
+    def fadeout(self, duration):
+        pass  # the song is busy until the recorded end of the fade out
+
+    def set_volume(self, volume):
+        pass
+
+    def get_busy(self):
+        return self._busy
+
+    def set_endevent(self, event_type=None):
+        pass
+
+
+class NullMixer(object):
+    """Stands in for :mod:`pygame.mixer`"""
+    def __init__(self):
+        self.music = NullMusic()
+
+    def init(self):
+        pass
+
+    def quit(self):
+        pass
+
+
+class FakeFileSystem(object):
+    """
+    Song library in a temporary directory, rebuilt from the songs recorded in a trace. The paths of
+    the trace are mapped to the temporary directory, paths outside the recorded roots are never touched.
+    """
+    def __init__(self, work_path, roots):
+        """
+        :param str work_path: Temporary directory to build the song library in
+        :param list roots: Recorded root directories of the song library, ending with a path separator
+        """
+        self._roots = [(root, os.path.join(work_path, 'root %s' % index, '')) for index, root in enumerate(roots)]
+        self._stubs = dict()
+
+    @property
+    def base_paths(self):
+        """Gets the root directories in the temporary directory"""
+        return [mapped for _, mapped in self._roots]
+
+    def map(self, path):
+        """Gets the path in the temporary directory of a recorded path, None if it is outside the roots"""
+        if not path:
+            return None
+        for root, mapped in self._roots:
+            if path == root.rstrip(os.sep):
+                return mapped.rstrip(os.sep)
+            if path.startswith(root):
+                return mapped + path[len(root):]
+        return None
+
+    def create(self, path, is_directory=False):
+        """Creates a song directory or a synthetic song, a song with an unknown format is not empty"""
+        if is_directory:
+            os.makedirs(path, exist_ok=True)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        extension = os.path.splitext(path)[1].lower()
+        if extension not in self._stubs:
+            stub = synthetic.STUBS.get(extension)
+            self._stubs[extension] = stub(0) if stub else b'\0'
+        with open(path, 'wb') as song_file:
+            song_file.write(self._stubs[extension])
+
+    def apply(self, event_type, src, dest, is_directory):
+        """Applies a recorded change of the file system to mapped paths"""
+        if event_type == 'created' and not os.path.exists(src):
+            self.create(src, is_directory)
+        elif event_type == 'deleted':
+            if os.path.isdir(src):
+                shutil.rmtree(src, ignore_errors=True)
+            elif os.path.exists(src):
+                os.remove(src)
+        elif event_type == 'moved' and dest:
+            if os.path.exists(src):
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                os.replace(src, dest)
+            else:
+                self.create(dest, is_directory)
+
+    def sync(self, directory, names):
+        """
+        Makes a song directory contain the given songs.
+
+        :return: True if the song directory has changed
+        """
+        existing = set(os.listdir(directory)) if os.path.isdir(directory) else set()
+        if existing == set(names):
+            return False
+        for name in existing - set(names):
+            os.remove(os.path.join(directory, name))
+        for name in set(names) - existing:
+            self.create(os.path.join(directory, name))
+        return True
+
+
+def summarize(times):
+    """Gets the statistics of handling times in milliseconds, in the format of :func:`suite.measure`"""
+    times = sorted(times)
+    return {
+        'runs': len(times),
+        'min_ms': times[0],
+        'median_ms': statistics.median(times),
+        'mean_ms': statistics.mean(times),
+        'p95_ms': times[min(len(times) - 1, int(len(times) * .95))],
+        'max_ms': times[-1],
+    }
+
+
+def drain(controller):
+    """Executes the commands handed over to the controller, like its event loop does"""
+    try:
+        os.read(controller._wakeup_reader, 512)
+    except BlockingIOError:
+        pass
+    while controller._commands:
+        command, args = controller._commands.popleft()
+        try:
+            command(*args)
+        except Exception as ex:
+            logging.error(ex)
+
+
+def compare_transitions(recorded, replayed):
+    """
+    Compares the recorded transitions of the player with the replayed ones.
+
+    :return: Dictionary with the number of transitions and the first one which differs, if any
+    """
+    result = {'recorded': len(recorded), 'replayed': len(replayed), 'diverged_at': None}
+    for index, (expected, actual) in enumerate(zip(recorded, replayed)):
+        if expected != actual:
+            result.update(diverged_at=index, expected=expected, actual=actual)
+            break
+    else:
+        if len(recorded) != len(replayed):
+            result['diverged_at'] = min(len(recorded), len(replayed))
+    return result
+
+
+def replay(path, work_path, realtime=False, order='name', slowest=10):
+    """
+    Replays a trace.
+
+    :param str path: Path of the trace file
+    :param str work_path: Temporary directory to rebuild the song library in
+    :param bool realtime: Replay the records at their recorded time instead of as fast as possible
+    :param str order: Order of the songs the trace was recorded with
+    :param int slowest: Number of the slowest records to report
+    :return: Dictionary with the statistics of the handling times by kind of record, the slowest
+        records and the comparison of the transitions of the player
+    """
+    records = list(read_trace(path))
+    snapshot = next((record for record in records if record[1] == LIBRARY), None)
+    if snapshot is None:
+        raise ValueError('%s contains no song library, the library was not scanned while it was recorded' % path)
+    started_at, _, (roots, songs) = snapshot
+
+    file_system = FakeFileSystem(work_path, roots)
+    for song in songs:
+        file_system.create(file_system.map(song))
+    supported = sorted(set(os.path.splitext(song)[1].lower() for song in songs)) or ['.mp3', '.ogg']
+
+    player_module.mixer = NullMixer()
+    replayed_path = os.path.join(work_path, 'replayed.trace')
+    recorder = TraceRecorder(replayed_path)
+    recorder.start()
+    library = Library(base_path=file_system.base_paths, supported=supported, order=order, rescan_debounce_ms=0,
+                      mount_watch=False, index_path=os.path.join(work_path, 'index.json'))
+    library._rescan_library()
+    library.ready.set()
+
+    times = dict((name, list()) for name in KIND_NAMES.values())
+    handled = list()
+    recorded = list()
+    skipped = 0
+    with Player(head_cache_bytes=0, staging_bytes=0, normalize=False, load_deadline_ms=0, trace=recorder) as player:
+        controller = Controller(player, library, event=threading.Event(), resume=False)
+        replay_started = time.perf_counter()
+        for elapsed, kind, fields in records:
+            if kind == LIBRARY or (kind in (EVENT, LISTING) and elapsed < started_at):
+                # the file system events until the library was scanned are part of the recorded songs
+                skipped += kind == EVENT
+                continue
+            if kind == PLAYER:
+                recorded.append((fields[0], file_system.map(fields[1])))
+                continue
+            if realtime:
+                delay = replay_started + elapsed - started_at - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+
+            if kind == KEYS:
+                description = 'keys %s' % ''.join(chr(key) if 32 <= key < 127 else '?' for key in fields)
+                handle = (lambda keys: lambda: controller._on_keys(keys))(fields)
+            elif kind == EVENT:
+                event_type, src, dest, is_directory = fields
+                description = '%s %s%s' % (event_type, src, ' -> %s' % dest if dest else '')
+                src, dest = file_system.map(src), file_system.map(dest)
+                event_class = EVENT_CLASSES.get((event_type, is_directory))
+                if src is None or event_class is None:
+                    skipped += 1
+                    continue
+                file_system.apply(event_type, src, dest, is_directory)
+                event = event_class(src, dest) if event_type == 'moved' else event_class(src)
+                handle = (lambda event: lambda: library.on_any_event(event))(event)
+            elif kind == LISTING:
+                # the library found other songs than the replayed file system events left behind
+                directory = file_system.map(fields[0])
+                if directory is None or not file_system.sync(directory, fields[1]):
+                    continue
+                description = 'listed %s' % fields[0]
+                handle = (lambda event: lambda: library.on_any_event(event))(DirModifiedEvent(directory))
+            elif fields == NEXT_SONG and player.state == PLAYING:
+                description = 'end of song'
+                handle = controller._next_song
+            elif fields == STOP and player.state == FADING:
+                description = 'end of fade out'
+                handle = controller._fade_complete
+            else:
+                # the player took another path than while the trace was recorded
+                skipped += 1
+                continue
+
+            started = time.perf_counter()
+            handle()
+            drain(controller)
+            duration = (time.perf_counter() - started) * 1000
+            times[KIND_NAMES[kind]].append(duration)
+            handled.append((duration, elapsed, description))
+
+        replay_seconds = time.perf_counter() - replay_started
+        player._halt()
+        os.close(controller._wakeup_reader)
+        os.close(controller._wakeup_writer)
+    recorder.stop()
+
+    replayed = [fields for _, kind, fields in read_trace(replayed_path) if kind == PLAYER]
+    handled.sort(reverse=True)
+    return {
+        'records': dict((name, summarize(durations)) for name, durations in times.items() if durations),
+        'slowest': [{'ms': duration, 'at_s': elapsed, 'record': description}
+                    for duration, elapsed, description in handled[:slowest]],
+        'skipped': skipped,
+        'replay_s': replay_seconds,
+        'transitions': compare_transitions(recorded, replayed),
+    }
+
+
+def report(results):
+    """Prints the handling times and whether the replay diverged from the recording"""
+    print('%-8s %7s %9s %9s %9s %9s' % ('record', 'count', 'median', 'mean', 'p95', 'max'))
+    for name, stats in sorted(results['records'].items()):
+        print('%-8s %7s %6.3f ms %6.3f ms %6.3f ms %6.3f ms' % (
+            name, stats['runs'], stats['median_ms'], stats['mean_ms'], stats['p95_ms'], stats['max_ms']))
+    print('slowest records:')
+    for slow in results['slowest']:
+        print('  %8.3f ms at %8.3f s  %s' % (slow['ms'], slow['at_s'], slow['record']))
+
+    transitions = results['transitions']
+    if transitions['diverged_at'] is None:
+        print('replayed %s records in %.1f s, %s skipped, all %s player transitions match' % (
+            sum(stats['runs'] for stats in results['records'].values()), results['replay_s'], results['skipped'],
+            transitions['recorded']))
+    else:
+        print('player transitions diverged at %s of %s recorded (%s replayed): expected %s, got %s' % (
+            transitions['diverged_at'], transitions['recorded'], transitions['replayed'],
+            transitions.get('expected'), transitions.get('actual')))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='replay a trace and time the handling of every record')
+    parser.add_argument('trace', help='trace recorded with philipplay --record-trace')
+    parser.add_argument('--realtime', action='store_true', help='replay the records at their recorded time')
+    parser.add_argument('--order', default='name', choices=('name', 'track'),
+                        help='order of the songs the trace was recorded with')
+    parser.add_argument('--slowest', type=int, default=10, help='number of the slowest records to report')
+    parser.add_argument('--output', help='file to write the JSON results to')
+    parser.add_argument('--baseline', help='JSON results of an earlier replay to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown of the median against the baseline reported as regression')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    work_path = tempfile.mkdtemp(prefix='philipplay-replay-')
+    try:
+        results = replay(args.trace, work_path, args.realtime, args.order, args.slowest)
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+    report(results)
+
+    name = os.path.basename(args.trace)
+    output = {'environment': describe(), 'results': {name: results['records']}, 'replay': results}
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(output, output_file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline:
+            regressions = compare(output['results'], json.load(baseline)['results'], args.threshold)
+        if regressions:
+            print('%s records regressed: %s' % (len(regressions), ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
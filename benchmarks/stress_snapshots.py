@@ -0,0 +1,156 @@
+"""
+Stress test of the library snapshots shared between the watchdog and the controller thread.
+
+A writer thread applies batches of file system events and rescans to a synthetic song
+library as fast as it can, while a reader thread moves the cursor and reads the selected
+song like the controller does. The reader checks that it never sees a song which was never
+part of the library and that the selected song survives every change which does not remove it.
+
+    python benchmarks/stress_snapshots.py --seconds 10
+"""
+import argparse
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from watchdog.events import DirModifiedEvent, FileCreatedEvent, FileMovedEvent
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import synthetic  # noqa: E402
+from philipplay.library import Library  # noqa: E402
+
+FAKE_MARKER = ' fake '
+
+
+class Writer(threading.Thread):
+    """Applies random batches of events: fake songs are created and removed, directories are rescanned"""
+    def __init__(self, library, directories, known, stop):
+        super(Writer, self).__init__(name='writer')
+        self.batches = 0
+        self._library = library
+        self._directories = directories
+        self._known = known
+        self._done = stop
+        self._fakes = list()
+        self._random = random.Random(1)
+
+    def run(self):
+        counter = 0
+        while not self._done.is_set():
+            events = list()
+            for _ in range(self._random.randint(1, 20)):
+                action = self._random.random()
+                if action < .5 or not self._fakes:
+                    counter += 1
+                    # fake songs are sorted between the songs of the library, so they move their positions
+                    name = '%03d%s%06d.ogg' % (self._random.randrange(30), FAKE_MARKER, counter)
+                    song = os.path.join(self._random.choice(self._directories), name)
+                    self._known.add(song)
+                    self._fakes.append(song)
+                    events.append(FileCreatedEvent(song))
+                elif action < .95:
+                    song = self._fakes.pop(self._random.randrange(len(self._fakes)))
+                    events.append(FileMovedEvent(song, '/nonexistent/%s' % os.path.basename(song)))
+                else:
+                    # the directory is listed again, which drops all of its fake songs
+                    directory = self._random.choice(self._directories)
+                    self._fakes = [song for song in self._fakes if os.path.dirname(song) != directory]
+                    events.append(DirModifiedEvent(directory))
+            self._library._apply_events(events)
+            self.batches += 1
+            if self.batches % 500 == 0:
+                self._library._rescan_library()
+
+
+class Reader(threading.Thread):
+    """Moves the cursor like the controller and checks what it reads"""
+    def __init__(self, library, known, stop):
+        super(Reader, self).__init__(name='reader')
+        self.operations = 0
+        self.errors = list()
+        self.latencies = list()
+        self._library = library
+        self._known = known
+        self._done = stop
+        self._random = random.Random(2)
+
+    def check(self, condition, message, *args):
+        if not condition:
+            self.errors.append(message % args)
+
+    def run(self):
+        library = self._library
+        while not self._done.is_set():
+            started = time.perf_counter()
+            action = self._random.random()
+            if action < .05:
+                library.library = self._random.randrange(9)
+            library.next()
+            song = library.song
+            playlist = library.playlist
+            upcoming = library.upcoming
+            self.latencies.append(time.perf_counter() - started)
+            self.operations += 1
+
+            # the songs of the original library are never removed, so the cursor must not move
+            pinned = song is not None and FAKE_MARKER not in os.path.basename(song)
+            time.sleep(.0001)
+            again = library.song
+
+            if song is None:
+                continue
+            self.check(song in self._known, 'unknown song %s', song)
+            self.check(upcoming in self._known, 'unknown upcoming song %s', upcoming)
+            self.check(bool(playlist), 'empty playlist for song %s', song)
+            self.check(not pinned or again == song, 'cursor moved from %s to %s', song, again)
+            if len(self.errors) > 20:
+                return
+
+
+def main():
+    parser = argparse.ArgumentParser(description='stress the library snapshots with concurrent readers and writers')
+    parser.add_argument('--seconds', type=float, default=5, help='duration of the test')
+    parser.add_argument('--folders', type=int, default=20, help='number of song directories')
+    parser.add_argument('--files', type=int, default=20, help='number of songs per directory')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    work_path = tempfile.mkdtemp(prefix='philipplay-stress-')
+    try:
+        base_path = os.path.join(work_path, 'library')
+        directories = synthetic.generate(base_path, args.folders, args.files, seconds=.1)
+        known = set(os.path.join(directory, entry) for directory in directories for entry in os.listdir(directory))
+
+        library = Library(base_path=base_path, index_path=os.path.join(work_path, 'index.json'), rescan_debounce_ms=0)
+        library._rescan_library()
+
+        stop = threading.Event()
+        writer = Writer(library, directories, known, stop)
+        reader = Reader(library, known, stop)
+        writer.start()
+        reader.start()
+        stop.wait(args.seconds)
+        stop.set()
+        writer.join()
+        reader.join()
+    finally:
+        shutil.rmtree(work_path, ignore_errors=True)
+
+    latencies = sorted(reader.latencies)
+    print('writer applied %s batches, reader did %s operations' % (writer.batches, reader.operations))
+    if latencies:
+        print('reader latency: median %.1f us, p99 %.1f us, max %.1f us' % (
+            latencies[len(latencies) // 2] * 1e6, latencies[int(len(latencies) * .99)] * 1e6, latencies[-1] * 1e6))
+    for error in reader.errors:
+        print('error: %s' % error)
+    sys.exit(1 if reader.errors else 0)
+
+
+if __name__ == '__main__':
+    main()
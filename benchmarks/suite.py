@@ -0,0 +1,235 @@
+"""
+Benchmark suite of the song library and the controller on synthetic song libraries.
+
+Every library size is generated in a temporary directory (see :mod:`synthetic`) and the
+library scan, the file event handlers, the song cursor and the key dispatch of the
+controller are timed. The audio runs on the SDL dummy driver, so no sound card is needed.
+The results are written as JSON and can be compared against the results of an earlier run:
+
+    python benchmarks/suite.py --output before.json
+    python benchmarks/suite.py --output after.json --baseline before.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pygame  # noqa: E402
+
+import synthetic  # noqa: E402
+from philipplay.controller import Controller  # noqa: E402
+from philipplay.library import Library  # noqa: E402
+from philipplay.player import Player  # noqa: E402
+
+DEFAULT_SIZES = '10x10,100x20,1000x10'
+
+
+def measure(function, repeat, setup=None):
+    """
+    Times a function a number of times.
+
+    :param callable function: Function to time
+    :param int repeat: Number of runs
+    :param callable setup: Called before every run, not timed
+    :return: Dictionary with the statistics of the runs in milliseconds
+    """
+    times = list()
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = time.perf_counter()
+        function()
+        times.append((time.perf_counter() - started) * 1000)
+    times.sort()
+    return {
+        'runs': len(times),
+        'min_ms': times[0],
+        'median_ms': statistics.median(times),
+        'mean_ms': statistics.mean(times),
+        'p95_ms': times[min(len(times) - 1, int(len(times) * .95))],
+    }
+
+
+def new_library(base_path, index_path):
+    """Creates a library without starting it, so no file system observer is running"""
+    return Library(base_path=base_path, index_path=index_path, rescan_debounce_ms=0)
+
+
+def bench_library(base_path, work_path, repeat):
+    """Times the library scan, the file event handlers and the song cursor"""
+    index_path = os.path.join(work_path, 'index.json')
+    results = dict()
+
+    def remove_index():
+        if os.path.exists(index_path):
+            os.remove(index_path)
+
+    results['rescan_cold'] = measure(lambda: new_library(base_path, index_path)._rescan_library(),
+                                     repeat, setup=remove_index)
+    # the index only stores directories older than the racy window of FAT file systems
+    past = time.time() - 60
+    for entry in os.scandir(base_path):
+        os.utime(entry.path, (past, past))
+    new_library(base_path, index_path)._rescan_library()
+    results['rescan_warm'] = measure(lambda: new_library(base_path, index_path)._rescan_library(), repeat)
+
+    library = new_library(base_path, index_path)
+    library._rescan_library()
+    directories = library._snapshot.directories
+    directory = directories[len(directories) // 2]
+    library.library = directories.index(directory)
+    library.next()
+    new_songs = [os.path.join(directory, '%05d new song.ogg' % index) for index in range(repeat)]
+
+    # the handlers update the song libraries of a new snapshot, publishing it is timed as well
+    def apply(handler, songs):
+        libraries = dict(library._snapshot.libraries)
+        handler(next(songs), libraries)
+        library._publish(libraries)
+
+    created = iter(new_songs)
+    results['on_file_created'] = measure(lambda: apply(library._on_file_created, created), repeat)
+    removed = iter(new_songs)
+    results['on_file_removed'] = measure(lambda: apply(library._on_file_removed, removed), repeat)
+
+    def next_song():
+        library.next()
+        return library.song
+
+    results['next_song'] = measure(next_song, repeat * 10)
+    return results
+
+
+def bench_controller(base_path, work_path, repeat):
+    """Times the key dispatch of the controller, including loading and starting the songs"""
+    library = new_library(base_path, os.path.join(work_path, 'index.json'))
+    library._rescan_library()
+    library.ready.set()  # otherwise the controller waits for the library to be scanned
+    results = dict()
+    with Player(head_cache_bytes=0, staging_bytes=0, normalize=False, fadeout=0) as player:
+        controller = Controller(player, library, event=None)
+        keys = [pygame.K_1 + index % min(9, len(library._snapshot.directories)) for index in range(repeat)]
+
+        pressed = iter(keys)
+        results['dispatch_select'] = measure(lambda: controller._on_press(next(pressed), 0), repeat,
+                                             setup=player._halt)
+        pressed = iter(keys)
+        results['dispatch_select_fading'] = measure(lambda: controller._on_press(next(pressed), 0), repeat)
+        results['dispatch_volume'] = measure(lambda: controller._on_press(pygame.K_UP, 0), repeat)
+        player._halt()
+        os.close(controller._wakeup_reader)
+        os.close(controller._wakeup_writer)
+    return results
+
+
+def run(sizes, repeat, seconds):
+    """Runs all benchmarks for every library size"""
+    results = dict()
+    for size in sizes:
+        folders, files = size
+        name = '%sx%s' % size
+        work_path = tempfile.mkdtemp(prefix='philipplay-bench-')
+        try:
+            base_path = os.path.join(work_path, 'library')
+            started = time.perf_counter()
+            synthetic.generate(base_path, folders, files, seconds)
+            print('generated %s folders with %s songs in %.1f s' % (folders, files, time.perf_counter() - started))
+
+            results[name] = {'folders': folders, 'files': files}
+            results[name].update(bench_library(base_path, work_path, repeat))
+            results[name].update(bench_controller(base_path, work_path, repeat))
+        finally:
+            shutil.rmtree(work_path, ignore_errors=True)
+    return results
+
+
+def describe():
+    """Gets the environment the benchmarks were run in"""
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'pygame': pygame.version.ver,
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """
+    Prints the change of the median of every benchmark against a baseline.
+
+    :return: Names of the benchmarks which are slower than the threshold allows
+    """
+    regressions = list()
+    for size, benchmarks in sorted(results.items()):
+        for name, stats in sorted(benchmarks.items()):
+            before = baseline.get(size, {}).get(name)
+            if not isinstance(stats, dict) or not isinstance(before, dict) or not before['median_ms']:
+                continue
+            ratio = stats['median_ms'] / before['median_ms']
+            flag = ''
+            if ratio > threshold:
+                flag = '  REGRESSION'
+                regressions.append('%s/%s' % (size, name))
+            print('%-10s %-24s %9.3f ms -> %9.3f ms  %5.2fx%s' % (
+                size, name, before['median_ms'], stats['median_ms'], ratio, flag))
+    return regressions
+
+
+def parse_sizes(value):
+    sizes = list()
+    for size in value.split(','):
+        folders, _, files = size.partition('x')
+        sizes.append((int(folders), int(files)))
+    return sizes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the song library and the controller')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, type=parse_sizes,
+                        help='library sizes as FOLDERSxFILES, comma separated (default: %s)' % DEFAULT_SIZES)
+    parser.add_argument('--repeat', type=int, default=20, help='number of runs of every benchmark')
+    parser.add_argument('--seconds', type=float, default=1., help='length of the synthetic songs')
+    parser.add_argument('--output', help='file to write the JSON results to, printed if not set')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown of the median against the baseline reported as regression')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    pygame.display.init()
+    report = {'environment': describe(), 'results': run(args.sizes, args.repeat, args.seconds)}
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=2, sort_keys=True))
+
+    if args.baseline:
+        with open(args.baseline, 'r') as baseline:
+            regressions = compare(report['results'], json.load(baseline)['results'], args.threshold)
+        if regressions:
+            print('%s benchmarks regressed: %s' % (len(regressions), ', '.join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""
+Generator of synthetic song libraries for the benchmarks.
+
+The songs are tiny but valid audio files which the pygame mixer can load and play: an
+Ogg Vorbis stream of silent packets and MPEG-1 layer III frames of silence.
+
+    python benchmarks/synthetic.py /tmp/library --folders 100 --files 20
+"""
+import argparse
+import os
+import struct
+
+SAMPLE_RATE = 44100
+
+# MPEG-1 layer III, 128 kbit/s, 44.1 kHz, mono. A frame of zeros decodes to silence.
+MP3_HEADER = b'\xff\xfb\x90\xc4'
+MP3_FRAME_BYTES = 417
+MP3_FRAME_SAMPLES = 1152
+
+# a Vorbis short block of 256 samples, following short blocks add 128 samples each
+VORBIS_BLOCK_SAMPLES = 128
+
+
+def _crc_table():
+    table = list()
+    for index in range(256):
+        value = index << 24
+        for _ in range(8):
+            value = ((value << 1) ^ 0x04c11db7) if value & 0x80000000 else value << 1
+        table.append(value & 0xffffffff)
+    return table
+
+
+CRC_TABLE = _crc_table()
+
+
+def _ogg_crc(data):
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xffffffff) ^ CRC_TABLE[((crc >> 24) ^ byte) & 0xff]
+    return crc
+
+
+def _ogg_page(packets, sequence, granule, flags=0):
+    """Builds an Ogg page containing the given complete packets"""
+    lacing = list()
+    for packet in packets:
+        lacing.extend([255] * (len(packet) // 255) + [len(packet) % 255])
+    header = b'OggS' + struct.pack('<BBqIIIB', 0, flags, granule, 1, sequence, 0, len(lacing)) + bytes(lacing)
+    page = header + b''.join(packets)
+    return page[:22] + struct.pack('<I', _ogg_crc(page)) + page[26:]
+
+
+class _BitWriter(object):
+    """Packs values least significant bit first, as the Vorbis headers are packed"""
+    def __init__(self):
+        self._value = 0
+        self._bits = 0
+
+    def write(self, value, bits):
+        self._value |= (value & ((1 << bits) - 1)) << self._bits
+        self._bits += bits
+        return self
+
+    def to_bytes(self):
+        return self._value.to_bytes((self._bits + 7) // 8, 'little')
+
+
+def _vorbis_setup():
+    """Builds the smallest valid Vorbis setup header: one of every kind and short blocks only"""
+    bits = _BitWriter()
+    bits.write(0, 8)  # one codebook with two entries of length one
+    bits.write(0x564342, 24).write(1, 16).write(2, 24).write(0, 1).write(0, 1).write(0, 5).write(0, 5).write(0, 4)
+    bits.write(0, 6).write(0, 16)  # one time domain transform
+    bits.write(0, 6).write(1, 16).write(0, 5).write(0, 2).write(4, 4)  # one floor of type 1 without partitions
+    bits.write(0, 6).write(0, 16)  # one residue of type 0
+    bits.write(0, 24).write(0, 24).write(0, 24).write(0, 6).write(0, 8).write(0, 3).write(0, 1)
+    bits.write(0, 6).write(0, 16).write(0, 1).write(0, 1).write(0, 2)  # one mapping of type 0
+    bits.write(0, 8).write(0, 8).write(0, 8)
+    bits.write(0, 6).write(0, 1).write(0, 16).write(0, 16).write(0, 8)  # one mode of short blocks
+    bits.write(1, 1)  # framing bit
+    return b'\x05vorbis' + bits.to_bytes()
+
+
+def ogg_stub(seconds=1.):
+    """
+    Builds an Ogg Vorbis file of silence.
+
+    :param float seconds: Length of the song
+    :return: The content of the file
+    """
+    identification = b'\x01vorbis' + struct.pack('<IBIiiiBB', 0, 1, SAMPLE_RATE, 0, 0, 0, 0xb8, 1)
+    comment = b'\x03vorbis' + struct.pack('<I', 9) + b'synthetic' + struct.pack('<I', 0) + b'\x01'
+    pages = [_ogg_page([identification], 0, 0, flags=2), _ogg_page([comment, _vorbis_setup()], 1, 0)]
+
+    # every audio packet has a single unused floor, which decodes to a block of silence
+    blocks = max(2, int(seconds * SAMPLE_RATE / VORBIS_BLOCK_SAMPLES) + 1)
+    granule = 0
+    for start in range(0, blocks, 255):
+        count = min(255, blocks - start)
+        granule += (count if start else count - 1) * VORBIS_BLOCK_SAMPLES
+        last = start + count >= blocks
+        pages.append(_ogg_page([b'\x00'] * count, len(pages), granule, flags=4 if last else 0))
+    return b''.join(pages)
+
+
+def mp3_stub(seconds=1.):
+    """
+    Builds an MP3 file of silence.
+
+    :param float seconds: Length of the song
+    :return: The content of the file
+    """
+    frames = max(1, int(seconds * SAMPLE_RATE / MP3_FRAME_SAMPLES))
+    return (MP3_HEADER + bytes(MP3_FRAME_BYTES - len(MP3_HEADER))) * frames
+
+
+STUBS = {'.ogg': ogg_stub, '.mp3': mp3_stub}
+
+
+def song_name(index, extension):
+    return '%03d song %s%s' % (index + 1, index, extension)
+
+
+def generate(base_path, folders, files, seconds=1., extensions=('.ogg', '.mp3')):
+    """
+    Generates a song library with the given number of song directories and songs per directory.
+    The song formats alternate between the given extensions, every stub is built only once.
+
+    :param str base_path: Root directory of the song library, created if needed
+    :param int folders: Number of song directories
+    :param int files: Number of songs per song directory
+    :param float seconds: Length of every song
+    :return: Sorted list of the song directories
+    """
+    contents = dict((extension, STUBS[extension](seconds)) for extension in extensions)
+    directories = list()
+    for folder in range(folders):
+        directory = os.path.join(base_path, 'folder %04d' % folder)
+        os.makedirs(directory, exist_ok=True)
+        for index in range(files):
+            extension = extensions[index % len(extensions)]
+            with open(os.path.join(directory, song_name(index, extension)), 'wb') as song_file:
+                song_file.write(contents[extension])
+        directories.append(directory)
+    return directories
+
+
+def main():
+    parser = argparse.ArgumentParser(description='generate a synthetic song library')
+    parser.add_argument('base_path', help='root directory of the song library')
+    parser.add_argument('--folders', type=int, default=10, help='number of song directories')
+    parser.add_argument('--files', type=int, default=10, help='number of songs per directory')
+    parser.add_argument('--seconds', type=float, default=1., help='length of every song')
+    args = parser.parse_args()
+    generate(args.base_path, args.folders, args.files, args.seconds)
+
+
+if __name__ == '__main__':
+    main()
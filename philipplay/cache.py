@@ -0,0 +1,180 @@
+import io
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class HeadFile(io.RawIOBase):
+    """
+    Read-only file which serves the cached head of a song from memory. The file itself is
+    only opened once the mixer reads beyond the cached head.
+    """
+    def __init__(self, filename, head, size):
+        """
+        Initializes a new instance of the :class:`HeadFile` class.
+
+        :param str filename: Absolute path to the audio file
+        :param bytes head: Cached first bytes of the audio file
+        :param int size: Size of the whole audio file
+        """
+        super(HeadFile, self).__init__()
+        self.name = filename
+        self._head = head
+        self._size = size
+        self._position = 0
+        self._file = None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = max(0, offset)
+        return self._position
+
+    def readinto(self, buffer):
+        buffer = memoryview(buffer).cast('B')
+        count = 0
+        if self._position < len(self._head):
+            chunk = self._head[self._position:self._position + len(buffer)]
+            buffer[:len(chunk)] = chunk
+            self._position += len(chunk)
+            count = len(chunk)
+            if count == len(buffer) or self._position < len(self._head):
+                return count
+        if self._position >= self._size:
+            return count  # the whole song is served from memory
+
+        if self._file is None:
+            self._file = open(self.name, 'rb')
+        if self._file.tell() != self._position:
+            self._file.seek(self._position)
+        read = self._file.readinto(buffer[count:]) or 0
+        self._position += read
+        return count + read
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        super(HeadFile, self).close()
+
+
+class HeadCache(object):
+    """
+    Memory cache of the first bytes of songs, filled by a background thread.
+
+    The cached head of a song is enough for the mixer to start playing without waiting for
+    the USB stick. Heads are cached in the order of importance until the size budget is used up.
+    """
+    def __init__(self, **kwargs):
+        """
+        Initializes a new instance of the :class:`HeadCache` class.
+
+        :param int head_cache_bytes: Size budget of the whole cache
+        :param int head_bytes: Number of bytes cached per song
+        """
+        self._budget = kwargs.get('head_cache_bytes', 8 * 1024 * 1024)
+        self._head_bytes = kwargs.get('head_bytes', 256 * 1024)
+        self._heads = dict()
+        self._size = 0
+        self._songs = set()
+        self._wanted = list()
+        self._running = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='philipplay-headcache', daemon=True)
+
+    def start(self):
+        """Starts the background thread filling the cache"""
+        self._running = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread"""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+    def warm(self, songs):
+        """
+        Replaces the songs to be cached. Heads of other songs are evicted, the heads of
+        the given songs are read in the background.
+
+        :param list songs: Absolute paths of the songs to cache, most important first
+        """
+        with self._condition:
+            self._songs = set(songs)
+            for song in set(self._heads) - self._songs:
+                self._evict(song)
+            self._wanted = [song for song in songs if song not in self._heads]
+            self._condition.notify()
+
+    def open(self, filename):
+        """
+        Opens a song from the cache.
+
+        :return: A :class:`HeadFile` serving the cached head, or None if the song is not cached
+        """
+        with self._condition:
+            entry = self._heads.get(filename)
+            if entry is None:
+                return None
+
+        mtime, size, head = entry
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        if (stat.st_mtime_ns, stat.st_size) != (mtime, size):
+            with self._condition:
+                self._evict(filename)
+            return None
+
+        logger.debug('open song %s from cache', filename)
+        return HeadFile(filename, head, size)
+
+    def _evict(self, song):
+        """Removes the head of a song from the cache"""
+        entry = self._heads.pop(song, None)
+        if entry is not None:
+            self._size -= len(entry[2])
+
+    def _run(self):
+        """Reads the heads of the wanted songs"""
+        while True:
+            with self._condition:
+                while self._running and not self._wanted:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                song = self._wanted.pop(0)
+
+            try:
+                with open(song, 'rb') as song_file:
+                    stat = os.fstat(song_file.fileno())
+                    head = song_file.read(self._head_bytes)
+            except OSError as ex:
+                logger.debug('can\'t cache song %s: %s', song, ex)
+                continue
+
+            with self._condition:
+                if song in self._heads or song not in self._songs:
+                    continue
+                if self._size + len(head) > self._budget:
+                    logger.debug('head cache is full, skip song %s', song)
+                    continue
+                self._heads[song] = (stat.st_mtime_ns, stat.st_size, head)
+                self._size += len(head)
+            logger.debug('cached %s bytes of song %s', len(head), song)
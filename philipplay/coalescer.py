@@ -0,0 +1,156 @@
+import concurrent.futures
+import logging
+import threading
+import time
+
+from philipplay import metrics
+
+logger = logging.getLogger(__name__)
+
+BACKLOG = metrics.gauge('philipplay_event_backlog', 'Number of events waiting to be handed over in a batch')
+BATCHES = metrics.counter('philipplay_event_batches_total', 'Number of event batches handed over')
+
+
+class EventCoalescer(object):
+    """
+    Collects events from a producer thread and hands them over in batches.
+
+    A batch is handed over as soon as no new event arrived for the quiet window. To keep
+    a continuous stream of events from delaying a batch forever, a batch is handed over
+    at the latest after the maximum delay.
+    """
+    def __init__(self, callback, window, max_delay=None):
+        """
+        Initializes a new instance of the :class:`EventCoalescer` class.
+
+        :param callable callback: Called with the list of collected events of a batch
+        :param float window: Quiet window in seconds
+        :param float max_delay: Maximum time in seconds a batch is delayed, defaults to ten quiet windows
+        """
+        self._callback = callback
+        self._window = window
+        self._max_delay = max_delay if max_delay is not None else window * 10
+        self._events = list()
+        self._first = 0
+        self._last = 0
+        self._running = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='philipplay-coalescer', daemon=True)
+
+    def start(self):
+        """Starts handing over batches"""
+        self._running = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops handing over batches, pending events are dropped"""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+    def add(self, event):
+        """Adds an event to the current batch"""
+        with self._condition:
+            self._last = time.monotonic()
+            if not self._events:
+                self._first = self._last
+            self._events.append(event)
+            BACKLOG.set(len(self._events))
+            self._condition.notify()
+
+    def _run(self):
+        """Waits for the quiet window of every batch and hands it over"""
+        while True:
+            with self._condition:
+                while self._running and not self._events:
+                    self._condition.wait()
+
+                while self._running:
+                    remaining = min(self._last + self._window, self._first + self._max_delay) - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+
+                if not self._running:
+                    return
+                batch, self._events = self._events, list()
+                BACKLOG.set(0)
+
+            BATCHES.inc()
+            try:
+                self._callback(batch)
+            except Exception as ex:
+                logger.exception(ex)
+
+
+class AsyncEventCoalescer(object):
+    """
+    Collects events from a producer thread on an asyncio event loop and hands them over in batches.
+
+    The batches are formed like the batches of :class:`EventCoalescer`, but the quiet window is
+    a timer of the event loop instead of a waiting thread. The callback is called in a worker
+    thread, so listing song directories never blocks the event loop.
+    """
+    def __init__(self, callback, window, loop, max_delay=None):
+        """
+        Initializes a new instance of the :class:`AsyncEventCoalescer` class.
+
+        :param callable callback: Called with the list of collected events of a batch
+        :param float window: Quiet window in seconds
+        :param asyncio.AbstractEventLoop loop: Event loop to run the timers on
+        :param float max_delay: Maximum time in seconds a batch is delayed, defaults to ten quiet windows
+        """
+        self._callback = callback
+        self._window = window
+        self._max_delay = max_delay if max_delay is not None else window * 10
+        self._loop = loop
+        self._events = list()
+        self._first = 0
+        self._timer = None
+        self._running = False
+        # a single worker, so batches are never applied concurrently
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def start(self):
+        """Starts handing over batches"""
+        self._running = True
+
+    def stop(self):
+        """Stops handing over batches, pending events are dropped"""
+        self._running = False
+        self._executor.shutdown(wait=True)
+
+    def add(self, event):
+        """Adds an event to the current batch, may be called from any thread"""
+        self._loop.call_soon_threadsafe(self._add, event)
+
+    def _add(self, event):
+        if not self._running:
+            return
+
+        now = self._loop.time()
+        if not self._events:
+            self._first = now
+        self._events.append(event)
+        BACKLOG.set(len(self._events))
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = self._loop.call_at(min(now + self._window, self._first + self._max_delay), self._flush)
+
+    def _flush(self):
+        """Hands over the current batch once the quiet window has passed"""
+        self._timer = None
+        batch, self._events = self._events, list()
+        BACKLOG.set(0)
+        if not self._running or not batch:
+            return
+
+        BATCHES.inc()
+        future = self._loop.run_in_executor(self._executor, self._callback, batch)
+        future.add_done_callback(self._on_done)
+
+    @staticmethod
+    def _on_done(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error('can\'t apply events: %s', future.exception())
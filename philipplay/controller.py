@@ -1,33 +1,79 @@
+import collections
 import logging
+import os
+import select
+import signal
 import threading
+import time
 
 import pygame
 
+from philipplay import metrics
+from philipplay.journal import ResumeJournal
 from philipplay.keyboard import Keyboard
-from philipplay.player import NEXT_SONG
+from philipplay.player import NEXT_SONG, STOP, IDLE, PLAYING, FADING
 
 logger = logging.getLogger(__name__)
 
+KEY_PRESSES = metrics.counter('philipplay_key_presses_total', 'Number of keys pressed')
+KEY_DISPATCH = metrics.histogram('philipplay_key_dispatch_seconds', 'Time to handle a key press')
+VOLUME_STEPS = {
+    pygame.K_UP: .05, pygame.K_PLUS: .05, pygame.K_PERIOD: .05,
+    pygame.K_DOWN: -.05, pygame.K_MINUS: -.05, pygame.K_COMMA: -.05,
+}
+SONG_SWITCH = metrics.histogram('philipplay_song_switch_seconds',
+                                'Time from the end of a song until the next song was started or its switch handled')
+
 
 class Controller(threading.Thread):
-    def __init__(self, player, library, event):
+    def __init__(self, player, library, event, **kwargs):
         """
         Initializes a new instance of the :class:`Controller` class.
 
+        The controller sleeps until a key is pressed or another thread hands over work. Only
+        while a song is played or faded out, it wakes up periodically to receive the end
+        events of the mixer, which can't be waited for. Keys are accepted before the library
+        has been scanned, a song selected meanwhile is played as soon as the scan has completed.
+
         :param philipplay.player.Player player: Audio player
         :param philipplay.library.Library library: Audio library to play songs from
         :param threading.Event event: Event to shutdown the whole application
+        :param int end_poll_ms: Interval to check for the end of a song while a song is played
+        :param int fade_poll_ms: Interval to check for the end of a fade out
+        :param bool resume: Resume the song played before the last shutdown
+            (see :class:`philipplay.journal.ResumeJournal`)
+        :param philipplay.trace.TraceRecorder trace: Recorder of the keys and the end events of the mixer, if set
         """
         threading.Thread.__init__(self, target=self._run, name='philipplay-eventloop')
         self._player = player
         self._library = library
         self._library.on_changed = self._on_library_changed
+        self._library.on_ready = self._on_library_ready
+        self._library.on_unmounted = self._on_library_unmounted
+        self._library.blacklist = self._player.blacklist
+        self._player.on_failed = self._on_song_failed
+        self._selection = None
+        self._journal = ResumeJournal(**kwargs) if kwargs.get('resume', True) else None
+        if self._journal:
+            self._journal.position = lambda: self._player.position
+        self._resume = None
+        self._trace = kwargs.get('trace')
         self._event = event
+        self._end_poll = kwargs.get('end_poll_ms', 250) / 1000
+        # the mixer posts an end event at most this long before it is received
+        self._polled = time.perf_counter()
+        self._fade_poll = kwargs.get('fade_poll_ms', 50) / 1000
+        self._commands = collections.deque()
+        self._wakeup_reader, self._wakeup_writer = os.pipe()
+        os.set_blocking(self._wakeup_reader, False)
+        os.set_blocking(self._wakeup_writer, False)
 
     def __enter__(self):
         """Starts the controller and all needed subtasks"""
         logger.debug('Attach keyboard listener')
         self._keyboard = Keyboard()
+        self._player.warm(self._library.heads)
+        self._start_journal()
         self.start()
         return self
 
@@ -35,26 +81,124 @@ class Controller(threading.Thread):
         """Stops the controller and cleanup all subtasks"""
         logger.debug('Detach keyboard listener')
         self._event.set()
+        self.wakeup()
         self.join()
         self._keyboard.set_normal_term()
+        if self._journal:
+            self._journal.stop()
+        os.close(self._wakeup_reader)
+        os.close(self._wakeup_writer)
+
+    def call_soon(self, command, *args):
+        """Hands over a command to be executed by the controller thread"""
+        self._commands.append((command, args))
+        self.wakeup()
+
+    def wakeup(self):
+        """Wakes up the controller thread"""
+        try:
+            os.write(self._wakeup_writer, b'\0')
+        except BlockingIOError:
+            pass  # the controller is going to wake up anyway
+
+    def _start_journal(self):
+        """Loads the song to resume, which is played as soon as the library has been scanned"""
+        if self._journal:
+            self._resume = self._journal.start()
+        if self._library.ready.is_set():
+            # the library was scanned before the controller was created
+            self.call_soon(self._select_pending)
+
+    def _record(self, playing=True):
+        """Records the current song in the resume journal"""
+        if self._journal and self._library.song:
+            offset = 0. if playing else self._player.position
+            self._journal.record(self._library.directory, self._library.song, playing, offset)
+
+    def _on_library_changed(self, directories=None):
+        self._player.invalidate(directories)
+        self.call_soon(self._check_song)
+        self._player.warm(self._library.heads)
+
+    def _check_song(self):
+        """Stops the player if the song played was removed from the library, other changes keep it playing"""
+        song = self._player.song
+        if song is None or song in self._library:
+            return
+        logger.info('Song %s was removed from the library. Stop player', song)
+        self._stop_song()
+
+    def _on_library_unmounted(self, base_path):
+        logger.info('%s was unmounted. Stop player right away', base_path)
+        self.call_soon(self._stop_song, False)
 
-    def _on_library_changed(self):
-        logger.info('Library changed. Stop player')
-        self._player.stop()
+    def _on_song_failed(self, song):
+        self.call_soon(self._skip_song, song)
+
+    def _on_library_ready(self):
+        self._player.warm(self._library.heads)
+        self.call_soon(self._select_pending)
+
+    def _select_pending(self):
+        """Plays the song which was selected before the library was scanned, or the song to resume"""
+        selection, self._selection = self._selection, None
+        resume, self._resume = self._resume, None
+        if selection is not None:
+            self._select_song(*selection)
+        elif resume is not None:
+            self._resume_song(resume)
+
+    def _resume_song(self, state):
+        """Selects the song played before the last shutdown and plays it from its last position"""
+        if not self._library.select(state['song']):
+            logger.info('song %s to resume is no longer part of the library', state['song'])
+            return
+
+        if not state['playing']:
+            logger.info('select stopped song %s', state['song'])
+            self._journal.record(self._library.directory, self._library.song, False, state['offset'])
+            return
+
+        logger.info('resume song %s at %.1f s', state['song'], state['offset'])
+        self._player.play(self._library.song, offset=state['offset'])
+        self._record()
+        self._player.queue(self._library.upcoming)
+        self._player.stage(self._library.directory, self._library.playlist)
+
+    def _skip_song(self, song):
+        """Plays the song following a song which can't be played"""
+        if song != self._library.song or self._player.state != IDLE:
+            return  # another song was selected meanwhile
+
+        self._library.next()
+        if self._library.song in self._player.blacklist:
+            logger.warning('no song of %s can be played', self._library.directory)
+            return
+
+        logger.info('skip song %s, play %s', song, self._library.song)
+        self._player.play(self._library.song)
+        self._record()
+        self._player.queue(self._library.upcoming)
+
+    def _stop_song(self, fade=True):
+        """Stops the player and records the position of the stopped song"""
+        if self._player.state == PLAYING:
+            self._record(playing=False)
+        self._player.stop(fade)
 
     # noinspection PyUnusedLocal
     def _on_press(self, key, mods):
         """Handles key press events from pygame"""
+        pressed = time.perf_counter()
+        KEY_PRESSES.inc()
         try:
-            if key == pygame.K_UP or key == pygame.K_PLUS or key == pygame.K_PERIOD:
-                self._player.volume += .05
-            elif key == pygame.K_DOWN or key == pygame.K_MINUS or key == pygame.K_COMMA:
-                self._player.volume -= .05
+            if key in VOLUME_STEPS:
+                self._player.ramp(VOLUME_STEPS[key])
 
             elif key == pygame.K_0 or key == pygame.K_s:
-                self._player.stop()
+                self._stop_song()
             elif pygame.K_1 <= key <= pygame.K_9:
-                self._select_song(key - pygame.K_0 - 1)
+                self._select_song(key - pygame.K_0 - 1, pressed)
 
             elif key == pygame.K_q:
                 logger.debug('Shutdown')
@@ -62,27 +206,267 @@ class Controller(threading.Thread):
 
         except Exception as ex:
             logger.error(ex)
+        KEY_DISPATCH.observe(time.perf_counter() - pressed)
+
+    def _on_keys(self, keys):
+        """
+        Handles the keys read at once. Repeated volume keys are folded into a single change of
+        the target volume, which the player approaches at a fixed rate.
+        """
+        if self._trace is not None:
+            self._trace.keys(keys)
+        step = 0.
+        for key in keys:
+            if key not in VOLUME_STEPS:
+                if step:
+                    self._player.ramp(step)
+                    step = 0.
+                self._on_press(key, 0)
+                continue
+
+            KEY_PRESSES.inc()
+            # the target volume is limited, so only keys of the same direction are folded
+            if step * VOLUME_STEPS[key] < 0:
+                self._player.ramp(step)
+                step = 0.
+            step += VOLUME_STEPS[key]
+        if step:
+            self._player.ramp(step)
 
-    def _select_song(self, index):
-        """Selects the song and used the player to play it"""
+    def _select_song(self, index, pressed=None):
+        """
+        Selects the song and used the player to play it
+
+        :param float pressed: Time the key was pressed (:func:`time.perf_counter`), to measure the latency
+        """
         logger.debug('Select song %s', index)
+        if not self._library.ready.is_set():
+            logger.info('library is not scanned yet, play song %s once it is', index)
+            self._selection = (index, pressed)
+            return
+
         if self._library.library != index:
             self._library.library = index
 
         self._library.next()
-        self._player.play(self._library.song)
+        self._player.play(self._library.song, requested=pressed)
+        self._record()
+        self._player.queue(self._library.upcoming)
+        self._player.stage(self._library.directory, self._library.playlist)
+
+    def _next_song(self, polled=None):
+        """
+        Plays the next song of the current library after the current song has ended.
+
+        :param float polled: Time the mixer was polled for end events before (:func:`time.perf_counter`),
+            the current song ended after it. None to measure the switch from now.
+        """
+        started = time.perf_counter()
+        ended = self._song_end(polled, started)
+        self._library.next()
+        gapless = self._player.advance(self._library.song)
+        if not gapless:
+            self._player.play(self._library.song)
+        switched = time.perf_counter()
+        SONG_SWITCH.observe(switched - ended)
+        logger.info('switched to next song %.1f ms after the end of the song (%s, handled in %.1f ms)',
+                    (switched - ended) * 1000, 'queued' if gapless else 'loaded', (switched - started) * 1000)
+        self._player.queue(self._library.upcoming)
+        self._record()
+
+    def _song_end(self, polled, now):
+        """
+        Estimates the time the current song has ended, by its duration if it is known. Otherwise the
+        previous poll is taken, so the time since the end is never underestimated.
+        """
+        if polled is None:
+            return now
+        duration = self._library.duration(self._player.song)
+        if duration is None:
+            return polled
+        return min(now, max(polled, now - max(0., self._player.position - duration)))
+
+    def _fade_complete(self):
+        """Starts the song which was selected while the previous song faded out"""
+        if self._player.fade_complete():
+            self._player.queue(self._library.upcoming)
+
+    def _receive_events(self):
+        """Handles the end events posted by the mixer"""
+        polled, self._polled = self._polled, time.perf_counter()
+        for event in pygame.event.get():
+            if self._trace is not None and event.type in (NEXT_SONG, STOP):
+                self._trace.mixer(event.type)
+            if event.type == NEXT_SONG:
+                self._next_song(polled)
+            elif event.type == STOP:
+                self._fade_complete()
+
+    def _timeout(self):
+        """Gets the time to sleep until the mixer needs to be checked for end events"""
+        state = self._player.state
+        if state == FADING:
+            return self._fade_poll
+        if state == PLAYING:
+            return self._end_poll
+        return None
 
     def _run(self):
         """Main loop of the controller"""
-
+        started = time.perf_counter()
+        wakeups = 0
         while not self._event.is_set():
-            for event in pygame.event.get():
-                if event.type == NEXT_SONG:
-                    self._library.next()
-                    self._player.play(self._library.song)
-            else:
-                if self._keyboard.key_pressed():
-                    key = self._keyboard.get_char()
-                    self._on_press(key, 0)
-
-            pygame.time.wait(100)
+            readers = [self._wakeup_reader]
+            keyboard = self._keyboard.fileno()
+            timeout = self._timeout()
+            ramp = self._player.update_volume()
+            if ramp is not None and (timeout is None or ramp < timeout):
+                timeout = ramp
+            if keyboard is not None:
+                readers.append(keyboard)
+            elif not self._keyboard.eof and (timeout is None or timeout > .1):
+                timeout = .1  # the keyboard can't be waited for and needs to be polled
+
+            readable, _, _ = select.select(readers, [], [], timeout)
+            woken = time.perf_counter()
+            wakeups += 1
+
+            if self._wakeup_reader in readable:
+                os.read(self._wakeup_reader, 512)
+            while self._commands:
+                command, args = self._commands.popleft()
+                try:
+                    command(*args)
+                except Exception as ex:
+                    logger.error(ex)
+
+            self._receive_events()
+
+            if keyboard in readable or (keyboard is None and not self._keyboard.eof and self._keyboard.key_pressed()):
+                keys = self._keyboard.get_chars()
+                self._on_keys(keys)
+                logger.debug('handled keys %s in %.1f ms', keys, (time.perf_counter() - woken) * 1000)
+
+        logger.info('event loop woke up %s times in %.0f s', wakeups, time.perf_counter() - started)
+
+
+class AsyncController(Controller):
+    """
+    Controller running on an asyncio event loop instead of its own thread.
+
+    Key presses are received by a reader of the event loop and work of other threads is handed
+    over with :meth:`asyncio.AbstractEventLoop.call_soon_threadsafe`. The end events of the mixer
+    are received by timers: at the end of a fade out, and periodically while a song is played.
+    While no song is played, the event loop does not wake up at all.
+    """
+    def __init__(self, player, library, event, loop, **kwargs):
+        """
+        Initializes a new instance of the :class:`AsyncController` class, see :class:`Controller`
+        for the other parameters.
+
+        :param asyncio.AbstractEventLoop loop: Event loop to run the controller on
+        """
+        Controller.__init__(self, player, library, event, **kwargs)
+        self._loop = loop
+        self._timer = None
+        self._reader = None
+        self._wakeups = 0
+
+    def __enter__(self):
+        """Attaches the controller to the event loop, which is run by :meth:`run_forever`"""
+        logger.debug('Attach keyboard listener')
+        self._keyboard = Keyboard()
+        self._player.warm(self._library.heads)
+        self._start_journal()
+        self._reader = self._keyboard.fileno()
+        if self._reader is not None:
+            self._loop.add_reader(self._reader, self._on_key)
+        try:
+            self._loop.add_signal_handler(signal.SIGINT, self._shutdown)
+        except (NotImplementedError, RuntimeError, ValueError):
+            pass  # signals can only be handled by the event loop of the main thread
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Detaches the controller from the event loop"""
+        logger.debug('Detach keyboard listener')
+        self._event.set()
+        if self._reader is not None:
+            self._loop.remove_reader(self._reader)
+        if self._timer is not None:
+            self._timer.cancel()
+        self._keyboard.set_normal_term()
+        if self._journal:
+            self._journal.stop()
+        os.close(self._wakeup_reader)
+        os.close(self._wakeup_writer)
+
+    def run_forever(self):
+        """Runs the event loop in the calling thread until the application is shut down"""
+        started = time.perf_counter()
+        self._loop.run_forever()
+        logger.info('event loop woke up %s times in %.0f s', self._wakeups, time.perf_counter() - started)
+
+    def call_soon(self, command, *args):
+        """Hands over a command to be executed by the event loop"""
+        self._loop.call_soon_threadsafe(self._execute, command, args)
+
+    def wakeup(self):
+        """Wakes up the event loop to check the state of the player"""
+        self._loop.call_soon_threadsafe(self._schedule)
+
+    def _execute(self, command, args):
+        self._wakeups += 1
+        try:
+            command(*args)
+        except Exception as ex:
+            logger.error(ex)
+        self._schedule()
+
+    def _on_key(self):
+        """Handles a key press, called by the event loop as soon as stdin is readable"""
+        woken = time.perf_counter()
+        self._wakeups += 1
+        keys = self._keyboard.get_chars()
+        if self._keyboard.eof:
+            self._loop.remove_reader(self._reader)
+            self._reader = None
+        if keys:
+            self._on_keys(keys)
+            logger.debug('handled keys %s in %.1f ms', keys, (time.perf_counter() - woken) * 1000)
+        self._schedule()
+
+    def _on_timer(self):
+        """Receives the end events of the mixer"""
+        self._timer = None
+        self._wakeups += 1
+        self._receive_events()
+        self._schedule()
+
+    def _schedule(self):
+        """Sets the timer to receive the next end event of the mixer, or stops the event loop on shutdown"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._event.is_set():
+            self._loop.stop()
+            return
+
+        state = self._player.state
+        delay = None
+        if state == FADING:
+            # the fade out ends at a known time, only poll if the mixer is late
+            delay = self._player.fade_remaining or self._fade_poll
+        elif state == PLAYING:
+            delay = self._end_poll
+        ramp = self._player.update_volume()
+        if ramp is not None and (delay is None or ramp < delay):
+            delay = ramp
+        if delay is None:
+            return
+        self._timer = self._loop.call_later(delay, self._on_timer)
+
+    def _shutdown(self):
+        logger.debug('Shutdown')
+        self._event.set()
+        self._schedule()
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+INDEX_VERSION = 2
+INDEX_FILE = '.philipplay-index.json'
+
+# the file names of a directory are stored as a single string, a file name can't contain a null character
+SEPARATOR = '\0'
+
+# FAT stores modification times with a two second resolution. A directory which
+# was indexed within this window could still change without its mtime changing.
+RACY_WINDOW = 2
+
+
+def base_paths(base_path):
+    """
+    Gets the root directories of a song library.
+
+    :param base_path: Root directory of the song library, or a list of root directories
+    :return: The root directories in the configured order, ending with a path separator
+    """
+    if isinstance(base_path, str):
+        base_path = [base_path]
+    paths = list()
+    for path in base_path:
+        path = os.path.join(os.path.expanduser(path), '')
+        if path not in paths:
+            paths.append(path)
+    return paths
+
+
+def cache_paths(base_path, file_name, path=None):
+    """
+    Gets the candidate paths of a cache file belonging to a song library.
+
+    :param str base_path: Root directory of the song library
+    :param str file_name: Name of the cache file on the device, e.g. '.philipplay-index.json'
+    :param str path: Configured path of the cache file, which is used exclusively if set
+    :return: The paths to try in order, the device itself and the users cache directory
+    """
+    if path:
+        return [os.path.expanduser(path)]
+
+    name = hashlib.sha1(base_path.encode('utf-8')).hexdigest()[:16]
+    return [
+        os.path.join(base_path, file_name),
+        os.path.join(os.path.expanduser('~/.cache/philipplay'), '%s-%s' % (name, file_name.lstrip('.'))),
+    ]
+
+
+def load_cache(paths, version, base_path, key='songs'):
+    """
+    Loads the entries of a cache file belonging to a song library.
+
+    :param list paths: Candidate paths of the cache file (see :func:`cache_paths`)
+    :param int version: Version of the cache format, a cache file of another version is skipped
+    :param str base_path: Root directory of the song library, a cache file of another root is skipped
+    :param str key: Key of the entries in the cache file
+    :return: Tuple of the path of the first readable cache file and its entries, (None, None) if there is none
+    """
+    for path in paths:
+        try:
+            with open(path, 'r') as cache_file:
+                data = json.load(cache_file)
+        except (OSError, ValueError):
+            continue
+        if data.get('version') == version and data.get('base_path') == base_path:
+            return path, data.get(key, {})
+    return None, None
+
+
+def save_cache(paths, version, base_path, entries, key='songs'):
+    """
+    Writes the entries of a cache file belonging to a song library to the first writable candidate path.
+    The file is replaced atomically, so a reader never sees a partially written cache.
+
+    :param list paths: Candidate paths of the cache file (see :func:`cache_paths`)
+    :param int version: Version of the cache format
+    :param str base_path: Root directory of the song library
+    :param dict entries: Entries of the cache
+    :param str key: Key of the entries in the cache file
+    :return: The path the cache was written to, None if no candidate path is writable
+    """
+    data = json.dumps({'version': version, 'base_path': base_path, key: entries})
+    for path in paths:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path + '.tmp', 'w') as cache_file:
+                cache_file.write(data)
+            os.replace(path + '.tmp', path)
+        except OSError as ex:
+            logger.debug('can\'t write cache file %s: %s', path, ex)
+            continue
+        return path
+    return None
+
+
+class LibraryIndex(object):
+    """
+    Persistent index of the song directories below the base path of a library.
+
+    Every directory is stored together with its modification time and the songs
+    found in it. As long as the modification time of a directory does not change,
+    the songs are taken from the index and the directory is not listed again.
+    """
+    def __init__(self, base_path, index_path=None):
+        """
+        Initializes a new instance of the :class:`LibraryIndex` class.
+
+        :param str base_path: Root directory of the song library
+        :param str index_path: Path of the index file. If not set, the index is stored
+            on the device itself, or in the users cache directory if the device is read-only
+        """
+        self._base_path = base_path
+        self._paths = cache_paths(base_path, INDEX_FILE, index_path)
+        self._entries = None
+        self._dirty = False
+
+    def __len__(self):
+        return len(self._entries or {})
+
+    def load(self):
+        """Loads the index from the first readable index file, if not already loaded"""
+        if self._entries is not None:
+            return
+
+        path, entries = load_cache(self._paths, INDEX_VERSION, self._base_path, key='directories')
+        self._entries = entries if entries is not None else dict()
+        if path is not None:
+            logger.debug('loaded library index %s with %s directories', path, len(self._entries))
+
+    def save(self):
+        """Writes the index to the first writable index file if it has changed"""
+        if not self._dirty:
+            return
+
+        path = save_cache(self._paths, INDEX_VERSION, self._base_path, self._entries, key='directories')
+        if path is None:
+            logger.warning('library index could not be saved')
+            return
+        logger.debug('saved library index %s', path)
+        self._dirty = False
+
+    def lookup(self, directory, stat):
+        """
+        Gets the indexed songs of a directory.
+
+        :param str directory: Absolute path of the song directory
+        :param os.stat_result stat: Current status of the song directory
+        :return: The file names of the songs, or None if the directory has changed since it was indexed
+        """
+        self.load()
+        entry = self._entries.get(directory)
+        # vfat assigns new inode numbers on every mount, so a directory is only identified by its path
+        if entry is None or entry['mtime'] != stat.st_mtime_ns:
+            return None
+        return entry['files'].split(SEPARATOR) if entry['files'] else list()
+
+    def update(self, directory, stat, names):
+        """
+        Stores the songs of a directory in the index.
+
+        :param str directory: Absolute path of the song directory
+        :param os.stat_result stat: Status of the song directory at the time it was listed
+        :param list names: File names of the songs found in the directory
+        """
+        self.load()
+        if time.time() - stat.st_mtime < RACY_WINDOW:
+            # the directory may still change unnoticed, list it again next time
+            self.discard(directory)
+            return
+
+        self._entries[directory] = {
+            'mtime': stat.st_mtime_ns,
+            'files': SEPARATOR.join(names),
+        }
+        self._dirty = True
+
+    def discard(self, directory):
+        """Removes a directory from the index"""
+        self.load()
+        if self._entries.pop(directory, None) is not None:
+            self._dirty = True
+
+    def retain(self, directories):
+        """Removes all directories from the index which are not part of the given directories"""
+        self.load()
+        for directory in set(self._entries) - set(directories):
+            self.discard(directory)
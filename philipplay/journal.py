@@ -0,0 +1,151 @@
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_VERSION = 1
+
+# the journal is compacted at runtime as well once it has grown by this number of records
+MAX_RECORDS = 1000
+
+
+class ResumeJournal(object):
+    """
+    Append-only journal of the song being played, to resume playback after a power loss.
+
+    Recording a song only updates the state in memory. A background thread appends the
+    state to the journal at a fixed interval if it has changed, so the SD card is written and
+    synced at most once per interval. The journal is compacted to its last record at startup.
+    """
+    def __init__(self, **kwargs):
+        """
+        Initializes a new instance of the :class:`ResumeJournal` class.
+
+        :param str journal_path: Path of the journal file
+        :param float journal_interval: Interval in seconds to write changes to the journal
+        """
+        self._path = os.path.expanduser(kwargs.get('journal_path', '~/.cache/philipplay/resume.journal'))
+        self._interval = kwargs.get('journal_interval', 30)
+        self._state = None
+        self._written = None
+        self._records = 0
+        self._running = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='philipplay-journal', daemon=True)
+        # called by the background thread to get the playback offset of the recorded song
+        self.position = lambda: 0.
+
+    def start(self):
+        """
+        Loads and compacts the journal and starts the background thread.
+
+        :return: The last recorded state (see :meth:`record`), or None if nothing was recorded
+        """
+        state = self._load()
+        if state is not None:
+            self._compact(state)
+        self._written = self._key(state)
+        self._running = True
+        self._thread.start()
+        return state
+
+    def stop(self):
+        """Stops the background thread and writes the current state"""
+        if not self._running:
+            return
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+        self._flush()
+
+    def record(self, directory, song, playing=True, offset=0.):
+        """
+        Records the song being played, without writing anything.
+
+        :param str directory: Song directory of the current song library
+        :param str song: Absolute path of the current song
+        :param bool playing: False if the song was stopped
+        :param float offset: Playback offset in seconds of a stopped song, the offset of a song
+            being played is taken from :attr:`position` when the state is written
+        """
+        with self._condition:
+            self._state = {'directory': directory, 'song': song, 'playing': playing, 'offset': offset}
+
+    @staticmethod
+    def _key(state):
+        """Gets the values of a state which are worth writing, the offset in whole seconds"""
+        if state is None:
+            return None
+        return state['directory'], state['song'], state['playing'], int(state.get('offset', 0))
+
+    def _run(self):
+        """Writes the state to the journal at the configured interval"""
+        while True:
+            with self._condition:
+                self._condition.wait(self._interval)
+                if not self._running:
+                    return
+            self._flush()
+
+    def _flush(self):
+        """Appends the current state to the journal if it has changed since it was written"""
+        with self._condition:
+            if self._state is None:
+                return
+            state = dict(self._state)
+        state['offset'] = round(self.position() if state['playing'] else state['offset'], 1)
+        key = self._key(state)
+        if key == self._written:
+            return
+
+        line = json.dumps(dict(state, version=JOURNAL_VERSION)) + '\n'
+        try:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            with open(self._path, 'a') as journal:
+                journal.write(line)
+                journal.flush()
+                os.fsync(journal.fileno())
+        except OSError as ex:
+            logger.warning('can\'t write resume journal %s: %s', self._path, ex)
+            return
+
+        self._written = key
+        self._records += 1
+        if self._records >= MAX_RECORDS:
+            self._compact(state)
+
+    def _load(self):
+        """Reads the last complete record of the journal"""
+        try:
+            with open(self._path, 'r') as journal:
+                lines = journal.readlines()
+        except OSError:
+            return None
+
+        # the last line may be incomplete if the power was lost while it was written
+        for line in reversed(lines):
+            try:
+                state = json.loads(line)
+            except ValueError:
+                continue
+            if isinstance(state, dict) and state.get('version') == JOURNAL_VERSION and state.get('song'):
+                logger.debug('loaded resume journal %s with %s records', self._path, len(lines))
+                return state
+        return None
+
+    def _compact(self, state):
+        """Replaces the journal by a journal containing only the given state"""
+        temp_path = self._path + '.tmp'
+        try:
+            with open(temp_path, 'w') as journal:
+                journal.write(json.dumps(dict(state, version=JOURNAL_VERSION)) + '\n')
+                journal.flush()
+                os.fsync(journal.fileno())
+            os.replace(temp_path, self._path)
+        except OSError as ex:
+            logger.warning('can\'t compact resume journal %s: %s', self._path, ex)
+            return
+        self._records = 1
@@ -31,6 +31,7 @@ class Keyboard:
     def __init__(self):
         """Creates a KBHit object that you can call to do various keyboard things."""
 
+        self.eof = False
         if os.name == 'nt':
             pass
         else:
@@ -67,11 +68,30 @@ class Keyboard:
         if os.name == 'nt':
             raw_char = msvcrt.get_char().decode('utf-8')
         else:
-            raw_char = sys.stdin.read(1)
+            # read unbuffered, a buffered read would hide pending characters from select
+            raw_char = os.read(self.fileno(), 1).decode('utf-8', 'ignore')
+            self.eof = self.eof or raw_char == ''
         raw_char = raw_char.strip().lower()
         if raw_char != '':
             return ord(raw_char)
 
+    def get_chars(self):
+        """
+        Returns all pending keyboard characters, read at once after kbhit() has been called.
+        Keys repeated while a key is held down are returned by a single call.
+        """
+        if os.name == 'nt':
+            chars = list()
+            while self.key_pressed():
+                char = self.get_char()
+                if char is not None:
+                    chars.append(char)
+            return chars
+
+        raw_chars = os.read(self.fileno(), 1024).decode('utf-8', 'ignore')
+        self.eof = self.eof or raw_chars == ''
+        return [ord(raw_char) for raw_char in raw_chars.lower() if not raw_char.isspace()]
+
     def get_arrow(self):
         """
         Returns an arrow-key code after kbhit() has been called. Codes are
@@ -90,6 +110,12 @@ class Keyboard:
             vals = [65, 67, 66, 68]
         return vals.index(ord(c.decode('utf-8')))
 
+    def fileno(self):
+        """Returns the file descriptor to wait for key presses, or None if waiting is not supported"""
+        if os.name == 'nt' or self.eof:
+            return None
+        return sys.stdin.fileno()
+
     def key_pressed(self):
         """Returns True if keyboard character was hit, False otherwise."""
         if os.name == 'nt':
@@ -1,154 +1,1042 @@
+import array
+import bisect
+import concurrent.futures
+import itertools
 import logging
 import os
+import re
+import sys
+import threading
+import time
 
 from watchdog.events import FileCreatedEvent, RegexMatchingEventHandler, FileMovedEvent, DirCreatedEvent, \
-    DirDeletedEvent, DirModifiedEvent
+    DirDeletedEvent, DirModifiedEvent, FileDeletedEvent
 from watchdog.observers import Observer
+from watchdog.observers.polling import PollingObserver
+
+from philipplay import metrics
+from philipplay.coalescer import AsyncEventCoalescer, EventCoalescer
+from philipplay.index import LibraryIndex, base_paths
+from philipplay.loader import Blacklist
+from philipplay.metadata import MetadataIndexer
+from philipplay.mounts import MountWatcher
 
 logger = logging.getLogger(__name__)
 
+RESCAN = metrics.histogram('philipplay_rescan_seconds', 'Time to scan a root directory of the song library')
+DIRECTORIES_LISTED = metrics.counter('philipplay_directories_listed_total', 'Number of song directories listed')
+FILES_SCANNED = metrics.counter('philipplay_files_scanned_total', 'Number of directory entries scanned for songs')
+EVENTS = metrics.counter('philipplay_watchdog_events_total', 'Number of file system events received')
+SUPPRESSED = metrics.counter('philipplay_watchdog_events_suppressed_total',
+                             'Number of file system events dropped while a root was mounted or unmounted')
+
+# events which change the library, others like opened or closed files are caused by reading songs
+LIBRARY_EVENTS = (DirCreatedEvent, DirModifiedEvent, DirDeletedEvent, FileCreatedEvent, FileMovedEvent)
+# events recorded to a trace, removed songs are needed to replay the changes of the file system
+TRACED_EVENTS = LIBRARY_EVENTS + (FileDeletedEvent,)
+
 
 class SongList(object):
-    def __init__(self, directory, songs):
-        self.directory = directory
-        self.songs = songs
+    """
+    Immutable songs of a song directory, sorted by their file name or by a custom sort key.
+
+    Only the file names of the songs are stored, packed into a single string in the order they
+    are played together with an array of their offsets. The absolute path of a song is built
+    when the song is read. A song is found by a binary search over the file names, adding or
+    removing a song creates a new list.
+    """
+    __slots__ = ('directory', '_key', '_names', '_offsets', '_by_name')
+
+    def __init__(self, directory, names=(), key=None):
+        """
+        Initializes a new instance of the :class:`SongList` class.
+
+        :param str directory: Absolute path of the song directory
+        :param names: File names of the songs in the directory
+        :param callable key: Gets the sort key of a song by its absolute path, songs are sorted by
+            their file name if not set
+        """
+        # the directory is shared by the snapshot, the index and every song list of the directory
+        self.directory = sys.intern(directory)
+        self._key = key
+        names = sorted(set(names))
+        if key:
+            names.sort(key=lambda name: (key(os.path.join(directory, name)), name))
+        self._pack(names)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        """Gets the absolute path of the song at the given position"""
+        offsets = self._offsets
+        count = len(offsets) - 1
+        if index < 0:
+            index += count
+        if not 0 <= index < count:
+            raise IndexError('song list index out of range')
+        return self.directory + os.sep + self._names[offsets[index]:offsets[index + 1]]
+
+    def __contains__(self, song):
+        directory, name = os.path.split(song)
+        return directory == self.directory and self._search(name)[1]
+
+    def __eq__(self, other):
+        return isinstance(other, SongList) and self.directory == other.directory \
+            and self._names == other._names and self._offsets == other._offsets
+
+    def __repr__(self):
+        return '%r' % (self.songs,)
+
+    @property
+    def songs(self):
+        """Gets the absolute paths of all songs, in the order they are played"""
+        prefix = self.directory + os.sep
+        return tuple(prefix + name for name in self.names)
+
+    @property
+    def names(self):
+        """Gets the file names of all songs, in the order they are played"""
+        offsets = self._offsets
+        return [self._names[offsets[index]:offsets[index + 1]] for index in range(len(self))]
+
+    def _pack(self, names):
+        """Packs the file names, which are already in the order they are played"""
+        self._names = ''.join(names)
+        self._offsets = array.array('I', itertools.accumulate(itertools.chain((0,), map(len, names))))
+        # the positions of the songs ordered by file name, only needed for a custom sort order
+        self._by_name = array.array('I', sorted(range(len(names)), key=names.__getitem__)) if self._key else None
+
+    def _name(self, index):
+        """Gets the file name of the song at the given position"""
+        return self._names[self._offsets[index]:self._offsets[index + 1]]
+
+    def _search(self, name):
+        """
+        Searches a file name.
+
+        :return: Tuple of the position the file name has or would have by file name, and whether it was found
+        """
+        by_name = self._by_name
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._name(by_name[middle] if by_name is not None else middle) < name:
+                low = middle + 1
+            else:
+                high = middle
+        found = low < len(self) and self._name(by_name[low] if by_name is not None else low) == name
+        return low, found
+
+    def _sort_key(self, index):
+        """Gets the sort key of the song at the given position"""
+        name = self._name(index)
+        return self._key(os.path.join(self.directory, name)), name
+
+    def index(self, song):
+        """Gets the position of a song"""
+        directory, name = os.path.split(song)
+        position, found = self._search(name)
+        if directory != self.directory or not found:
+            raise ValueError('%s is not in song list' % song)
+        return self._by_name[position] if self._by_name is not None else position
+
+    def position(self, song):
+        """Gets the position a song has or would have in the list"""
+        if song in self:
+            return self.index(song)
+        name = os.path.basename(song)
+        if not self._key:
+            return self._search(name)[0]
+
+        key = (self._key(song), name)
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._sort_key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def add(self, song):
+        """
+        Adds a song at its sorted position.
+
+        :return: A new song list containing the song, or None if the song was already part of the list
+        """
+        if song in self:
+            return None
+        names = self.names
+        names.insert(self.position(song), os.path.basename(song))
+        return self._copy(names)
+
+    def remove(self, song):
+        """
+        Removes a song.
+
+        :return: A new song list without the song, or None if the song was not part of the list
+        """
+        if song not in self:
+            return None
+        names = self.names
+        del names[self.index(song)]
+        return self._copy(names)
+
+    def _copy(self, names):
+        """Creates a song list of the same directory from file names in the order they are played"""
+        song_list = SongList.__new__(SongList)
+        song_list.directory = self.directory
+        song_list._key = self._key
+        song_list._pack(names)
+        return song_list
+
+
+class Snapshot(object):
+    """
+    Immutable state of all song libraries.
+
+    A snapshot is never changed once it was published. Every change of the songs creates a
+    new snapshot which replaces the previous one as a whole, so readers never see a half
+    applied change and never need to wait for a writer.
+    """
+    __slots__ = ('libraries', 'directories', 'heads', '_key', '_keys')
+
+    def __init__(self, libraries=None, key=None):
+        """
+        Initializes a new instance of the :class:`Snapshot` class.
+
+        :param dict libraries: The :class:`SongList` of every song directory, by the song directory
+        :param callable key: Gets the sort key of a song directory, directories are sorted by their path if not set
+        """
+        self.libraries = libraries or dict()
+        self._key = key
+        if key:
+            entries = sorted((key(directory), directory) for directory in self.libraries)
+            self.directories = tuple(directory for _, directory in entries)
+            self._keys = tuple(sort_key for sort_key, _ in entries)
+        else:
+            self.directories = tuple(sorted(self.libraries))
+            self._keys = self.directories
+        self.heads = tuple(self.libraries[directory][0] for directory in self.directories)
+
+    def __len__(self):
+        return len(self.directories)
+
+    def __getitem__(self, index):
+        """Gets the :class:`SongList` of a song library, None if there is no such song library"""
+        if not 0 <= index < len(self.directories):
+            return None
+        return self.libraries[self.directories[index]]
+
+    def find(self, directory):
+        """Gets the position a song directory has or would have in the snapshot"""
+        return bisect.bisect_left(self._keys, self._key(directory) if self._key else directory)
+
+
+class LibraryRoot(object):
+    """
+    Root directory containing one sub directory per song library.
+
+    Every root has its own index and its own file system observer, so a root is scanned and
+    watched independently of the other roots and can come and go with its device.
+    """
+    __slots__ = ('base_path', 'path', 'index', 'observer', 'watch', 'directories', 'mount', 'generation',
+                 'settle_until', 'lock')
+
+    def __init__(self, base_path, index_path=None):
+        """
+        Initializes a new instance of the :class:`LibraryRoot` class.
+
+        :param str base_path: Root directory, ending with a path separator
+        :param str index_path: Path of the persistent library index (see :class:`LibraryIndex`)
+        """
+        self.base_path = base_path
+        self.path = os.path.normpath(base_path)
+        self.index = LibraryIndex(base_path, index_path)
+        self.observer = None
+        # single recursive watch of the root, the events below the song directories are filtered
+        self.watch = None
+        # sub directories of the root found when it was listed the last time
+        self.directories = set()
+        # mount point and mount id of the file system the root is part of
+        self.mount = None
+        # number of mounts and unmounts, a scan started before one of them is outdated
+        self.generation = 0
+        # file system events of the root are dropped until this time, after it was mounted or unmounted
+        self.settle_until = 0
+        # held while the root is scanned
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return 'LibraryRoot(%r)' % self.base_path
+
+    def song_directory(self, path):
+        """
+        Gets the song directory a path belongs to.
+
+        :return: The song directory, the root itself if the path is the root or one of its
+            parents, or None if the path is not part of the root at all
+        """
+        path = os.path.normpath(path)
+        if self.path == path or self.path.startswith(os.path.join(path, '')):
+            return self.path
+        if not path.startswith(self.base_path):
+            return None
+        return os.path.join(self.base_path, path[len(self.base_path):].split(os.sep, 1)[0])
 
 
 class Library(RegexMatchingEventHandler):
     def __init__(self, **kwargs):
         """
         Initializes a new instance of the :class:`Library` class.
+
+        :param base_path: Root directory containing one sub directory per song library, or a list of root
+            directories which are scanned in parallel and merged into one library (see :class:`LibraryRoot`)
+        :param list supported: File extensions of the supported audio files
+        :param str index_path: Path of the persistent library index (see :class:`LibraryIndex`), only used
+            with a single root directory
+        :param int rescan_debounce_ms: Quiet window to collect file system events before they are applied
+        :param str observer: 'native' to watch the file system using inotify, 'polling' to poll it instead
+        :param float polling_interval: Interval in seconds to poll the file system with the polling observer
+        :param str order: 'name' to play the songs ordered by their file name, 'track' to order them by
+            the track number of their tags (see :class:`philipplay.metadata.MetadataIndexer`)
+        :param bool background_scan: Scan the library in a background thread when the library is started,
+            :attr:`ready` is set once the scan has completed
+        :param asyncio.AbstractEventLoop loop: Event loop to collect the file system events on, they are
+            collected by a thread if not set (see :class:`philipplay.coalescer.AsyncEventCoalescer`)
+        :param bool mount_watch: Watch the mount table to scan a root as a whole when its device is mounted,
+            and to drop its song libraries right away when it is unmounted (see :class:`MountWatcher`)
+        :param int mount_settle_ms: Time to drop the file system events of a root after it was mounted or
+            unmounted, as they are covered by its scan
+        :param philipplay.trace.TraceRecorder trace: Recorder of the songs and the file system events, if set
         """
         self._supported = kwargs.get('supported', ['.mp3', '.ogg'])
-        self._base_path = os.path.join(os.path.expanduser(kwargs.get('base_path', '~/Music')), '')
-        self._libraries = list()
-        self._current_library = 0
-        self._current_song = -1
+        paths = base_paths(kwargs.get('base_path', '~/Music'))
+        index_path = kwargs.get('index_path')
+        if index_path and len(paths) > 1:
+            logger.warning('index_path is ignored with more than one base_path')
+            index_path = None
+        self._roots = [LibraryRoot(path, index_path) for path in paths]
+        # the song libraries are ordered by the configured order of their root, then by their path
+        self._root_order = dict((root.path, order) for order, root in enumerate(self._roots))
+        self._order = kwargs.get('order', 'name')
+        # the metadata cache is stored with the first root, it covers the songs of all roots
+        self._metadata = MetadataIndexer(**dict(kwargs, base_path=paths[0])) if self._order == 'track' else None
+        if self._metadata:
+            self._metadata.on_indexed = self._on_metadata_indexed
+        # the songs are published as immutable snapshots, the cursor of the selected song
+        # belongs to the reading thread and is moved to the latest snapshot when it is read
+        self._snapshot = Snapshot()
+        self._cursor = (self._snapshot, 0, -1)
+        self._write_lock = threading.Lock()
+        # called with the set of changed song directories whenever songs have changed
         self.on_changed = lambda *a, **kw: None
+        # called once the library was scanned for the first time
+        self.on_ready = lambda *a, **kw: None
+        # called with the root directory when the device of a root was unmounted
+        self.on_unmounted = lambda *a, **kw: None
+        self.ready = threading.Event()
+        self.ready_at = None
+        # songs which are skipped as they can't be played, shared with the player
+        self.blacklist = Blacklist()
+        self._background_scan = kwargs.get('background_scan', False)
+        self._scanner = None
+        self._polling = kwargs.get('observer', 'native') == 'polling'
+        self._polling_interval = kwargs.get('polling_interval', 5)
+        self._mounts = MountWatcher(**kwargs) if kwargs.get('mount_watch', True) else None
+        if self._mounts:
+            self._mounts.on_changed = self._on_mounts_changed
+        self._mount_settle = kwargs.get('mount_settle_ms', 2000) / 1000
+        self._settle_until = 0
+        self._trace = kwargs.get('trace')
+
+        debounce = kwargs.get('rescan_debounce_ms', 500) / 1000
+        if kwargs.get('loop') is not None:
+            self._coalescer = AsyncEventCoalescer(self._apply_events, debounce, kwargs['loop'])
+        else:
+            self._coalescer = EventCoalescer(self._apply_events, debounce) if debounce > 0 else None
 
-        regexes = [
-            r'{root_dir}'.format(
-                root_dir=os.path.abspath(os.path.join(self._base_path, os.pardir)).replace('/', '\/')
-            )
-        ]
-        super(Library, self).__init__(regexes=regexes)
+        # only the roots, the song directories and the supported songs in them are of interest
+        extensions = '|'.join(re.escape(extension) for extension in self._supported)
+        regexes = list()
+        ignore_regexes = list()
+        for root in self._roots:
+            base_path = re.escape(root.path)
+            regexes.append(r'^{base_path}(/[^/]+)?$'.format(base_path=base_path))
+            regexes.append(r'^{base_path}/[^/]+/[^/]+({extensions})$'.format(
+                base_path=base_path, extensions=extensions))
+            ignore_regexes.append(r'^{base_path}/\.[^/]*$'.format(base_path=base_path))
+        super(Library, self).__init__(regexes=regexes, ignore_regexes=ignore_regexes, case_sensitive=False)
 
     def __enter__(self):
         """Starts the song library"""
-        self._rescan_library()
-        self._observer = Observer()
-        parent = os.path.abspath(os.path.join(self._base_path, os.pardir))
-        self._observer.schedule(self, path=parent, recursive=True)
-        self._observer.start()
+        for root in self._roots:
+            if self._polling:
+                root.observer = PollingObserver(timeout=self._polling_interval)
+            else:
+                root.observer = Observer()
+
+            # the parent is only watched to notice when the root is created or removed
+            parent = os.path.abspath(os.path.join(root.base_path, os.pardir))
+            root.observer.schedule(self, path=parent, recursive=False)
+        if self._metadata:
+            self._metadata.start()
+        if self._background_scan:
+            self._scanner = threading.Thread(target=self._start, name='philipplay-scanner', daemon=True)
+            self._scanner.start()
+        else:
+            self._start()
         return self
 
+    def _start(self):
+        """Scans the library for the first time and starts watching it"""
+        self._rescan_library()
+        if self._mounts:
+            mounts = self._mounts.start()
+            for root in self._roots:
+                root.mount = self._mount(root.path, mounts)
+        if self._coalescer:
+            self._coalescer.start()
+        for root in self._roots:
+            root.observer.start()
+        if self._trace is not None:
+            snapshot = self._snapshot
+            songs = [song for directory in snapshot.directories for song in snapshot.libraries[directory].songs]
+            self._trace.library([root.base_path for root in self._roots], songs)
+        self.ready_at = time.perf_counter()
+        self.ready.set()
+        self.on_ready()
+
     def __exit__(self, exc_type, exc_val, exc_tb):
         """Stops the song library"""
-        self._observer.stop()
-        self._observer.join()
+        if self._scanner:
+            self._scanner.join()
+        if self._mounts:
+            self._mounts.stop()
+        for root in self._roots:
+            root.observer.stop()
+        for root in self._roots:
+            root.observer.join()
+        if self._coalescer:
+            self._coalescer.stop()
+        if self._metadata:
+            self._metadata.stop()
+
+    def __contains__(self, song):
+        """Checks whether a song is part of the latest snapshot of the song libraries"""
+        library = self._snapshot.libraries.get(os.path.dirname(song))
+        return library is not None and song in library
+
+    def duration(self, song):
+        """Gets the duration of a song in seconds from its metadata, None if it is not known"""
+        metadata = self._metadata.get(song) if self._metadata and song else None
+        return metadata.get('duration') if metadata else None
 
     @property
     def library(self):
         """Gets the current selected song library"""
-        return self._current_library
+        return self._view()[1]
 
     @library.setter
     def library(self, value):
         """Selects a song library"""
-        if not self._libraries:
+        snapshot = self._snapshot
+        if not snapshot:
             return
 
-        self._current_library = value % len(self._libraries)
-        self._current_song = -1
+        self._cursor = (snapshot, value % len(snapshot), -1)
 
     @property
     def song(self):
         """Gets the current selected song of the current song library"""
-        if self._current_library >= len(self._libraries):
+        library, song = self._selected()
+        if library is None or not 0 <= song < len(library):
             return
-        if self._current_song >= len(self._libraries[self._current_library]):
+        return library[song]
+
+    @property
+    def directory(self):
+        """Gets the song directory of the current song library"""
+        library, _ = self._selected()
+        return library.directory if library is not None else None
+
+    @property
+    def playlist(self):
+        """Gets the songs of the current song library in the order they are played, starting with the current song"""
+        library, song = self._selected()
+        if library is None:
+            return list()
+        start = max(0, song)
+        songs = library.songs
+        return list(songs[start:] + songs[:start])
+
+    @property
+    def heads(self):
+        """Gets the first song of every song library"""
+        return list(self._snapshot.heads)
+
+    @property
+    def upcoming(self):
+        """Gets the song which follows the current selected song of the current song library"""
+        library, song = self._selected()
+        if library is None:
             return
-        return self._libraries[self._current_library][self._current_song]
+        return library[self._following(library, song)]
+
+    def select(self, song):
+        """
+        Selects a song and its song library.
+
+        :param str song: Absolute path of the song
+        :return: True if the song was selected, False if it isn't part of any song library
+        """
+        snapshot = self._snapshot
+        library = snapshot.libraries.get(os.path.dirname(song))
+        if library is None or song not in library:
+            return False
+
+        self._cursor = (snapshot, snapshot.find(library.directory), library.index(song))
+        return True
 
     def next(self):
-        """Selects the next song in the current song library"""
-        if not self._libraries:
+        """Selects the next song in the current song library, songs on the blacklist are skipped"""
+        snapshot, index, song = self._view()
+        library = snapshot[index]
+        if library is None:
             return
-        self._current_song = (self._current_song + 1) % len(self._libraries[self._current_library])
+        self._cursor = (snapshot, index, self._following(library, song))
+
+    def _following(self, library, song):
+        """
+        Gets the position of the song following a song which is not on the blacklist.
+
+        :return: The position of the song following the given song if all songs are on the blacklist
+        """
+        following = (song + 1) % len(library)
+        if not self.blacklist:
+            return following
+        for offset in range(1, len(library) + 1):
+            position = (song + offset) % len(library)
+            if library[position] not in self.blacklist:
+                return position
+        return following
+
+    def _selected(self):
+        """Gets the :class:`SongList` of the current song library and the position of the current song"""
+        snapshot, index, song = self._view()
+        return snapshot[index], song
+
+    def _view(self):
+        """Gets the cursor of the selected song, moved to the latest snapshot if the songs have changed"""
+        snapshot = self._snapshot
+        cursor = self._cursor
+        if cursor[0] is not snapshot:
+            cursor = self._cursor = self._remap(cursor, snapshot)
+        return cursor
+
+    @staticmethod
+    def _remap(cursor, snapshot):
+        """
+        Moves a cursor to another snapshot by the path of the selected song library and song.
+
+        A removed song is replaced by the song before its former position, so the song following
+        it is played next. If the song library was removed, the song library at the same position
+        is selected from its start.
+        """
+        previous, index, song = cursor
+        library = previous[index]
+        if library is None or library.directory not in snapshot.libraries:
+            return (snapshot, index % len(snapshot) if snapshot else index, -1)
+
+        index = snapshot.find(library.directory)
+        if not 0 <= song < len(library):
+            return (snapshot, index, -1)
+
+        path = library[song]
+        songs = snapshot[index]
+        song = songs.index(path) if path in songs else songs.position(path) - 1
+        return (snapshot, index, song)
 
     def _rescan_library(self):
-        """Scans the root directory for song libraries"""
-        self._libraries.clear()
+        """Scans all roots for song libraries"""
+        self._apply_libraries(self._scan_roots(self._roots))
+
+    def _scan_roots(self, roots):
+        """
+        Scans roots for song libraries, every root in its own worker thread if there is more than one.
+
+        :return: The song libraries of the roots, by their song directory
+        """
+        if len(roots) == 1:
+            results = [self._scan_root(roots[0])]
+        else:
+            options = dict()
+            if sys.version_info >= (3, 6):
+                options['thread_name_prefix'] = 'philipplay-scanner'
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(roots), **options) as executor:
+                results = list(executor.map(self._scan_root, roots))
+
+        libraries = dict()
+        for result in results:
+            libraries.update(result)
+        return libraries
+
+    def _scan_root(self, root, rewatch=False):
+        """
+        Scans a root directory for song libraries. Scans of the same root are serialized, as they
+        update the index and the watch of the root.
+
+        :param bool rewatch: Drop the watch of the root first, e.g. as it was taken on the
+            directory covered by a file system which was just mounted
+        :return: The song libraries of the root, by their song directory
+        """
+        with root.lock:
+            if rewatch:
+                self._unwatch(root)
+            logger.info('loading audio library %s', root.base_path)
+            if not os.path.isdir(root.base_path):
+                logger.info('audio library %s is empty', root.base_path)
+                self._unwatch(root)
+                root.directories = set()
+                return dict()
+
+            started = time.perf_counter()
+            root.index.load()
+            warm = len(root.index) > 0
+            directories = list()
+            libraries = dict()
+            listed = 0
+            entries = [entry for entry in sorted(os.scandir(root.base_path), key=lambda e: e.name) if entry.is_dir()]
+            self._watch(root)
+            root.directories = set(entry.path for entry in entries)
+            for entry in entries:
+                names, cached = self._scan_directory(root, entry.path, entry.stat())
+                listed += 0 if cached else 1
+                if names:
+                    library = self._song_list(entry.path, names)
+                    directories.append(library.directory)
+                    libraries[library.directory] = library
+
+            root.index.retain(directories)
+            root.index.save()
+            elapsed = time.perf_counter() - started
+            RESCAN.observe(elapsed)
+            logger.info('scanned audio library %s in %.1f ms (%s, %s directories listed)',
+                        root.base_path, elapsed * 1000, 'warm' if warm else 'cold', listed)
+            return libraries
+
+    def _apply_libraries(self, libraries):
+        """Replaces the song libraries and notifies about the change, if there is any"""
+        with self._write_lock:
+            previous = self._snapshot.libraries
+            if libraries == previous:
+                logger.debug('audio library unchanged')
+                return
+
+            changed = self._changed(previous, libraries)
+            self._publish(libraries)
+
+        self._index_metadata(changed)
+        self.on_changed(changed)
+
+    @staticmethod
+    def _changed(previous, libraries):
+        """Gets the song directories which were added, removed or changed between two states of the song libraries"""
+        changed = set(previous).symmetric_difference(libraries)
+        changed.update(directory for directory in libraries
+                       if directory in previous and previous[directory] != libraries[directory])
+        return changed
+
+    def _publish(self, libraries):
+        """Publishes a new snapshot of the song libraries, the caller holds the write lock"""
+        self._snapshot = Snapshot(libraries, key=self._directory_key if len(self._roots) > 1 else None)
+
+    def _directory_key(self, directory):
+        """Gets the sort key of a song directory, the order of its root and its path"""
+        return self._root_order.get(os.path.dirname(directory), len(self._roots)), directory
+
+    def _root(self, directory):
+        """Gets the :class:`LibraryRoot` of a song directory, None if the directory is not a song directory"""
+        order = self._root_order.get(os.path.dirname(directory))
+        return self._roots[order] if order is not None else None
 
-        logger.info('loading audio library %s', self._base_path)
-        if not os.path.isdir(self._base_path):
-            logger.info('audio library is empty')
-            self.on_changed()
+    def _rescan_directory(self, directory, libraries):
+        """
+        Lists a single song directory again and updates its song library if the songs have changed.
+
+        :param dict libraries: Song libraries of the snapshot being built, updated in place
+        :return: True if the song libraries have changed
+        """
+        root = self._root(directory)
+        if root is None:
+            return False
+
+        with root.lock:
+            try:
+                names, cached = self._scan_directory(root, directory, os.stat(directory))
+                root.directories.add(directory)
+            except OSError:
+                names = list()
+                root.directories.discard(directory)
+        if self._trace is not None:
+            self._trace.listing(directory, names)
+
+        library = libraries.get(directory)
+        songs = self._song_list(directory, names)
+        if library is not None and songs == library:
+            logger.debug('songs of directory %s unchanged', directory)
+            return False
+        if library is None and not songs:
+            return False
+
+        if not songs:
+            logger.info('remove library %s', directory)
+            del libraries[directory]
+            root.index.discard(directory)
+        elif library is None:
+            logger.info('add new library %s', directory)
+            libraries[directory] = songs
+        else:
+            logger.info('update songs of library %s', directory)
+            libraries[directory] = songs
+
+        root.index.save()
+        return True
+
+    def _scan_directory(self, root, directory, stat):
+        """
+        Gets the songs of a song directory, either from the index or by listing the directory.
+
+        :return: Tuple of the file names of the songs and whether they where taken from the index
+        """
+        names = root.index.lookup(directory, stat)
+        if names is not None:
+            return names, True
+
+        logger.info('adding songs from directory %s', directory)
+        entries = list(os.scandir(directory))
+        DIRECTORIES_LISTED.inc()
+        FILES_SCANNED.inc(len(entries))
+        names = sorted(
+            [entry.name
+             for entry in entries
+             if entry.is_file() and self._is_supported(entry.name)]
+        )
+        root.index.update(directory, stat, names)
+        return names, False
+
+    def _watch(self, root):
+        """
+        Watches a root by a single recursive watch of its observer. Every watch runs its own emitter
+        with its own inotify instance, so the song directories are not watched one by one. The
+        handler regexes drop the events below the song directories.
+        """
+        if root.observer is None or root.watch is not None:
+            return
+        try:
+            root.watch = root.observer.schedule(self, path=root.path, recursive=True)
+        except OSError as ex:
+            logger.warning('can\'t watch audio library %s: %s', root.base_path, ex)
+
+    def _unwatch(self, root):
+        """Stops watching a root"""
+        watch, root.watch = root.watch, None
+        if watch is None:
             return
+        try:
+            root.observer.unschedule(watch)
+        except (KeyError, OSError):
+            pass
+
+    def _is_supported(self, file_name):
+        """Checks whether the file is a supported audio file"""
+        return os.path.splitext(file_name.lower())[1] in self._supported
+
+    @staticmethod
+    def _mount(path, mounts):
+        """Gets the mount point and the mount id of the file system a path is part of"""
+        mount = None
+        for mount_point, mount_id in mounts.items():
+            if (path == mount_point or path.startswith(os.path.join(mount_point, ''))) \
+                    and (mount is None or len(mount_point) > len(mount[0])):
+                mount = (mount_point, mount_id)
+        return mount
 
-        for index, directory in enumerate(sorted(os.listdir(self._base_path))):
-            directory = os.path.join(self._base_path, directory)
-            if not os.path.isdir(directory):
+    def _on_mounts_changed(self, mounts):
+        """
+        Handles a change of the mount table. A root whose device was mounted is scanned as a whole,
+        the song libraries of a root whose device was unmounted are dropped without any file access.
+        """
+        for root in self._roots:
+            mount = self._mount(root.path, mounts)
+            if mount == root.mount:
                 continue
 
-            logger.info('adding songs from directory %s', directory)
-            self._libraries.append(sorted(
-                [os.path.join(directory, file)
-                 for file in os.listdir(directory)
-                 if os.path.isfile(os.path.join(directory, file))
-                 and os.path.splitext(file.lower())[1] in self._supported]
-            ))
+            previous, root.mount = root.mount, mount
+            root.generation += 1
+            root.settle_until = time.monotonic() + self._mount_settle
+            self._settle_until = max(self._settle_until, root.settle_until)
+            if previous is not None and mount is not None and len(mount[0]) < len(previous[0]):
+                logger.info('audio library %s was unmounted', root.base_path)
+                with root.lock:
+                    self._unwatch(root)
+                    root.directories = set()
+                self.on_unmounted(root.base_path)
+                self._apply_root(root, dict())
+            else:
+                logger.info('audio library %s was mounted', root.base_path)
+                self._apply_root(root, self._scan_root(root, rewatch=True))
 
-        self.library = self._current_library
-        self.on_changed()
+    def _apply_root(self, root, scanned):
+        """Replaces the song libraries of a root and notifies about the change, if there is any"""
+        if self.blacklist:
+            self.blacklist.refresh()
+        with self._write_lock:
+            libraries = dict(self._snapshot.libraries)
+            changed = self._replace_roots(libraries, [root], scanned)
+            if changed:
+                self._publish(libraries)
+
+        if changed:
+            self._index_metadata(changed)
+            self.on_changed(changed)
+
+    def _replace_roots(self, libraries, roots, scanned):
+        """
+        Replaces the song libraries of roots by the song libraries found by scanning them.
+
+        :param dict libraries: Song libraries of the snapshot being built, updated in place
+        :param dict scanned: Song libraries of the roots, by their song directory
+        :return: The song directories which have changed
+        """
+        paths = set(root.path for root in roots)
+        previous = dict((directory, library) for directory, library in libraries.items()
+                        if os.path.dirname(directory) in paths)
+        for directory in previous:
+            del libraries[directory]
+        libraries.update(scanned)
+        if self._trace is not None:
+            for directory, library in scanned.items():
+                self._trace.listing(directory, library.names)
+        return self._changed(previous, scanned)
+
+    def _settling(self, path):
+        """Checks whether a path belongs to a root which was just mounted or unmounted"""
+        now = time.monotonic()
+        if self._settle_until <= now:
+            return False
+        return any(root.settle_until > now and (path == root.path or path.startswith(root.base_path))
+                   for root in self._roots)
 
     def on_any_event(self, event):
-        if isinstance(event, (DirCreatedEvent, DirModifiedEvent, DirDeletedEvent)):
-            self._rescan_library()
+        EVENTS.inc()
+        if self._trace is not None and isinstance(event, TRACED_EVENTS):
+            self._trace.event(event)
+        if self.blacklist:
+            # a song which was copied again is played again
+            self.blacklist.refresh([str(event.src_path), str(getattr(event, 'dest_path', ''))])
+        if not isinstance(event, LIBRARY_EVENTS):
+            return
+        if self._settling(str(event.src_path)):
+            SUPPRESSED.inc()
+            return
+        if self._coalescer:
+            self._coalescer.add(event)
+        else:
+            self._apply_events([event])
+
+    def _apply_events(self, events):
+        """
+        Applies a batch of file system events in a single pass. Song directories with directory
+        events are listed once, file events are only applied to the other song directories.
+        A root which was created or removed is scanned again as a whole, the song libraries
+        of the other roots are not touched. A root which was only modified is listed, its song
+        directories which were added or removed are listed again like song directories with
+        directory events. So writing the caches into the root, e.g. the library index, does
+        not cause a scan.
+        """
+        roots = list()
+        modified = list()
+        directories = set()
+        files = list()
+        for event in events:
+            if self._settling(str(event.src_path)):
+                # collected before the mount or unmount of its root was noticed
+                SUPPRESSED.inc()
+                continue
 
-        elif isinstance(event, FileCreatedEvent):
-            self._on_file_created(str(event.src_path))
+            if isinstance(event, (DirCreatedEvent, DirModifiedEvent, DirDeletedEvent)):
+                for root in self._roots:
+                    directory = root.song_directory(str(event.src_path))
+                    if directory == root.path and isinstance(event, DirModifiedEvent) \
+                            and os.path.normpath(str(event.src_path)) == root.path:
+                        if root not in modified:
+                            modified.append(root)
+                    elif directory == root.path:
+                        if root not in roots:
+                            roots.append(root)
+                    elif directory is not None:
+                        directories.add(directory)
 
-        elif isinstance(event, FileMovedEvent):
-            self._on_file_removed(str(event.src_path))
-            self._on_file_created(str(event.dest_path))
+            elif isinstance(event, FileCreatedEvent):
+                files.append((None, str(event.src_path)))
 
-    def _on_file_removed(self, file_path):
-        changed = False
-        for index, library in enumerate(self._libraries[:]):
-            if file_path in library:
-                logger.info('remove song from directory %s', file_path)
-                library.remove(file_path)
-                changed = True
-                if not library:
-                    self._libraries.remove(library)
+            elif isinstance(event, FileMovedEvent):
+                files.append((str(event.src_path), str(event.dest_path)))
 
-        self.on_changed()
+        for root in modified:
+            if root in roots:
+                continue
+            added_or_removed = self._list_root(root)
+            if added_or_removed is None:
+                roots.append(root)
+            else:
+                directories.update(added_or_removed)
 
-    def _on_file_created(self, file_path):
-        dir_name, file_name = os.path.split(file_path)
-        if not dir_name.startswith(self._base_path):
-            return
+        logger.info('applied batch of %s raw events (%s directories, %s roots)',
+                    len(events), len(directories), len(roots))
+        generations = [root.generation for root in roots]
+        scanned = self._scan_roots(roots) if roots else dict()
+        rescanned = set(root.path for root in roots)
+        directories = set(directory for directory in directories if os.path.dirname(directory) not in rescanned)
+
+        def listed(path):
+            """Checks whether the song directory of a file is listed again or part of a root scanned again"""
+            directory = os.path.dirname(path)
+            return directory in directories or os.path.dirname(directory) in rescanned
+
+        changed = set()
+        with self._write_lock:
+            libraries = dict(self._snapshot.libraries)
+            # a root which was mounted or unmounted during the scan was published by the mount handler
+            outdated = set(root.path for root, generation in zip(roots, generations) if root.generation != generation)
+            if outdated:
+                logger.info('drop outdated scan of %s', ', '.join(sorted(outdated)))
+                roots = [root for root in roots if root.path not in outdated]
+                scanned = dict((directory, library) for directory, library in scanned.items()
+                               if os.path.dirname(directory) not in outdated)
+            if roots:
+                changed.update(self._replace_roots(libraries, roots, scanned))
 
-        library = [i for i, x in enumerate(self._libraries) if x[0].startswith(dir_name)]
-        if len(library) > 1:
-            logging.warning('can\'t add song, multiple libraries matches: %s', file_path)
+            for directory in sorted(directories):
+                if self._rescan_directory(directory, libraries):
+                    changed.add(directory)
+
+            for removed, created in files:
+                if removed and not listed(removed) and self._on_file_removed(removed, libraries):
+                    changed.add(os.path.dirname(removed))
+                if created and not listed(created) and self._on_file_created(created, libraries):
+                    changed.add(os.path.dirname(created))
+
+            if changed:
+                self._publish(libraries)
+
+        if changed:
+            self._index_metadata(changed)
+            self.on_changed(changed)
+
+    def _list_root(self, root):
+        """
+        Lists the sub directories of a root which was modified.
+
+        :return: The song directories which were added or removed since the root was scanned, None if
+            the root can't be listed
+        """
+        try:
+            listed = set(entry.path for entry in os.scandir(root.base_path) if entry.is_dir())
+        except OSError:
+            return None
+        with root.lock:
+            known = set(root.directories)
+        known.update(directory for directory in self._snapshot.libraries if os.path.dirname(directory) == root.path)
+        known.discard(root.path)
+        return listed.symmetric_difference(known)
+
+    def _song_list(self, directory, names):
+        """Creates the :class:`SongList` of a song directory from the file names, sorted in the configured order"""
+        return SongList(directory, names, key=self._track_key if self._order == 'track' else None)
+
+    def _track_key(self, song):
+        """Gets the sort key to order songs by their track number, songs without track number come last"""
+        metadata = self._metadata.get(song)
+        track = metadata.get('track') if metadata else None
+        return (0, track, song) if track is not None else (1, 0, song)
+
+    def _index_metadata(self, directories):
+        """Reads the metadata of the songs of changed song directories in the background"""
+        if not self._metadata:
             return
+        libraries = self._snapshot.libraries
+        for directory in directories:
+            library = libraries.get(directory)
+            if library is not None:
+                self._metadata.submit(directory, list(library.songs))
+
+    def _on_metadata_indexed(self, directory):
+        """Sorts the songs of a song directory again, once the metadata of its songs is known"""
+        with self._write_lock:
+            library = self._snapshot.libraries.get(directory)
+            if library is None:
+                return
 
-        if len(library) == 0:
+            ordered = self._song_list(directory, library.names)
+            if ordered == library:
+                return
+
+            logger.debug('order songs of %s by track number', directory)
+            libraries = dict(self._snapshot.libraries)
+            libraries[directory] = ordered
+            self._publish(libraries)
+
+    def _on_file_removed(self, file_path, libraries):
+        """
+        Removes a song from its song library.
+
+        :param dict libraries: Song libraries of the snapshot being built, updated in place
+        :return: True if the song libraries have changed
+        """
+        dir_name = os.path.dirname(file_path)
+        library = libraries.get(dir_name)
+        if library is None:
+            return False
+
+        library = library.remove(file_path)
+        if library is None:
+            return False
+
+        logger.info('remove song from directory %s', file_path)
+        if library:
+            libraries[dir_name] = library
+        else:
+            del libraries[dir_name]
+        return True
+
+    def _on_file_created(self, file_path, libraries):
+        """
+        Adds a song to its song library, a new song library is created if needed.
+
+        :param dict libraries: Song libraries of the snapshot being built, updated in place
+        :return: True if the song libraries have changed
+        """
+        dir_name, file_name = os.path.split(file_path)
+        if self._root(dir_name) is None or not self._is_supported(file_name):
+            return False
+
+        library = libraries.get(dir_name)
+        if library is None:
             logging.info('add new library: %s', dir_name)
-            self._libraries.append([file_path])
-            self._libraries = sorted(self._libraries)
-            self.on_changed()
-            return
+            libraries[dir_name] = self._song_list(dir_name, [file_name])
+            return True
+
+        library = library.add(file_path)
+        if library is None:
+            return False
 
-        index = library[0]
-        if file_path not in self._libraries[index]:
-            logging.info('add song to library: %s', file_path)
-            library = self._libraries[index]
-            library.append(file_path)
-            self._libraries[index] = sorted(library)
-            self.on_changed()
+        logging.info('add song to library: %s', file_path)
+        libraries[dir_name] = library
+        return True
 
     def __str__(self):
-        return '%s' % self._libraries
+        snapshot = self._snapshot
+        return '%s' % [snapshot.libraries[directory] for directory in snapshot.directories]
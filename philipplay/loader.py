@@ -0,0 +1,253 @@
+import logging
+import os
+import threading
+import time
+
+from philipplay import metrics
+
+logger = logging.getLogger(__name__)
+
+OPEN = metrics.histogram('philipplay_song_open_seconds', 'Time to open and validate a song')
+MISSED = metrics.counter('philipplay_song_open_missed_total', 'Number of songs skipped as they missed the deadline')
+BLACKLISTED = metrics.counter('philipplay_songs_blacklisted_total', 'Number of songs put on the blacklist')
+
+# number of bytes read to check the signature of a song
+SIGNATURE_BYTES = 12
+
+
+def check_signature(filename, head):
+    """
+    Checks the first bytes of a song against the signature of its file format. Formats without
+    a known signature are only checked to be not empty.
+
+    :param str filename: Path of the song, its extension names the file format
+    :param bytes head: First bytes of the song, at least :data:`SIGNATURE_BYTES` if the song is large enough
+    :raises ValueError: If the song does not match its file format
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if not head:
+        raise ValueError('%s is empty' % filename)
+    if extension == '.ogg':
+        valid = head.startswith(b'OggS')
+    elif extension == '.mp3':
+        # either tagged or starting with the sync word of an MPEG audio frame
+        valid = head.startswith(b'ID3') or (len(head) > 1 and head[0] == 0xff and head[1] & 0xe0 == 0xe0)
+    elif extension == '.wav':
+        valid = head.startswith(b'RIFF') and head[8:12] == b'WAVE'
+    elif extension == '.flac':
+        valid = head.startswith(b'fLaC')
+    else:
+        valid = True
+    if not valid:
+        raise ValueError('%s is no valid %s file' % (filename, extension[1:]))
+
+
+class Blacklist(object):
+    """
+    Songs which can't be played, together with the modification time of their file. A song
+    stays on the blacklist until its file is modified, e.g. once it was copied again.
+
+    Checking whether a song is on the blacklist does not access the file system. The file
+    system is only accessed by :meth:`refresh`, which is called by the threads watching it.
+    """
+    def __init__(self):
+        self._songs = dict()
+
+    def __len__(self):
+        return len(self._songs)
+
+    def __contains__(self, song):
+        return song in self._songs
+
+    def add(self, song, mtime):
+        """
+        Puts a song on the blacklist.
+
+        :param str song: Absolute path of the song
+        :param int mtime: Modification time of the song in nanoseconds, None while it is unknown
+            as the song could not be opened yet
+        """
+        if song not in self._songs:
+            BLACKLISTED.inc()
+            logger.warning('skip song %s until it %s', song, 'was opened' if mtime is None else 'is modified')
+        self._songs[song] = mtime
+
+    def discard(self, song):
+        """Removes a song from the blacklist"""
+        self._songs.pop(song, None)
+
+    def refresh(self, songs=None):
+        """
+        Removes the songs whose file was modified or removed since they were put on the blacklist.
+
+        :param songs: Songs to check, None to check all songs on the blacklist
+        """
+        for song, mtime in list(self._songs.items()):
+            if mtime is None:
+                continue  # the song is still being opened
+            if songs is not None and song not in songs:
+                continue
+            try:
+                modified = os.stat(song).st_mtime_ns != mtime
+            except FileNotFoundError:
+                modified = True
+            except OSError:
+                continue
+            if modified:
+                logger.info('song %s was modified, remove it from the blacklist', song)
+                self.discard(song)
+
+
+class _Request(object):
+    """Song to be opened by the worker of the :class:`SongLoader`"""
+    __slots__ = ('filename', 'prepare', 'source', 'error', 'size', 'mtime', 'done', 'abandoned')
+
+    def __init__(self, filename, prepare):
+        self.filename = filename
+        self.prepare = prepare
+        self.source = None
+        self.error = None
+        self.size = None
+        self.mtime = None
+        self.done = False
+        self.abandoned = False
+
+
+class SongLoader(object):
+    """
+    Opens and validates songs in a background thread, so a song on a hung device or a corrupt
+    song delays the player by at most the deadline.
+
+    A worker which misses the deadline is abandoned and the next song is opened by a new worker.
+    The song is put on the blacklist until the abandoned worker has returned: for good if the
+    song could not be opened, otherwise it is removed again. A song which could not be opened
+    stays on the blacklist until its file is modified.
+    """
+    def __init__(self, **kwargs):
+        """
+        Initializes a new instance of the :class:`SongLoader` class.
+
+        :param int load_deadline_ms: Time to wait for a song to be opened, 0 to open songs on the calling thread
+        """
+        self._deadline = kwargs.get('load_deadline_ms', 2000) / 1000
+        self._request = None
+        self._last = None
+        self._running = False
+        self._condition = threading.Condition()
+        self._thread = None
+        self.blacklist = Blacklist()
+
+    def start(self):
+        """Starts the worker opening the songs"""
+        if self._deadline <= 0:
+            return
+        self._running = True
+        self._spawn()
+
+    def stop(self):
+        """Stops the worker, an abandoned worker is left to return on its own"""
+        with self._condition:
+            self._running = False
+            thread, self._thread = self._thread, None
+            self._condition.notify_all()
+        if thread is not None:
+            thread.join()
+
+    def load(self, filename, prepare):
+        """
+        Opens a song, waits at most the deadline for it.
+
+        :param str filename: Absolute path of the song
+        :param prepare: Function which is called by the worker with the path of the song, to open and validate
+            it. It returns the source to load into the mixer and raises :class:`OSError` or :class:`ValueError`
+            if the song can't be played
+        :return: The source returned by `prepare`, None if the song must be skipped
+        """
+        if filename in self.blacklist:
+            logger.info('skip blacklisted song %s', filename)
+            return None
+
+        request = _Request(filename, prepare)
+        if not self._running:
+            self._open(request)
+        else:
+            with self._condition:
+                self._request = request
+                self._condition.notify_all()
+                if not self._condition.wait_for(lambda: request.done, self._deadline):
+                    MISSED.inc()
+                    logger.warning('song %s was not opened within %.0f ms', filename, self._deadline * 1000)
+                    request.abandoned = True
+                    self._request = None
+                    self.blacklist.add(filename, None)
+                    self._spawn()
+                    return None
+
+        self._last = request
+        if request.error is not None:
+            logger.warning('can\'t open song %s: %s', filename, request.error)
+            self.blacklist.add(filename, request.mtime)
+            return None
+        return request.source
+
+    def stat(self, filename):
+        """
+        Gets the size and modification time of a song as seen by the worker which opened it.
+
+        :return: Tuple of the size and the modification time in nanoseconds, None if the song was not
+            the last song opened
+        """
+        last = self._last
+        if last is None or last.filename != filename or last.mtime is None:
+            return None
+        return last.size, last.mtime
+
+    def reject(self, filename):
+        """Puts a song on the blacklist which was opened, but can't be played by the mixer"""
+        last = self._last
+        self.blacklist.add(filename, last.mtime if last is not None and last.filename == filename else None)
+
+    def _spawn(self):
+        """Starts a new worker, the previous one is abandoned"""
+        self._thread = threading.Thread(target=self._run, name='philipplay-loader', daemon=True)
+        self._thread.start()
+
+    def _open(self, request):
+        """Opens the song of a request"""
+        started = time.perf_counter()
+        try:
+            stat = os.stat(request.filename)
+            request.size, request.mtime = stat.st_size, stat.st_mtime_ns
+            request.source = request.prepare(request.filename)
+        except (OSError, ValueError) as ex:
+            request.error = ex
+        OPEN.observe(time.perf_counter() - started)
+
+    def _run(self):
+        """Opens the requested songs, until the worker is stopped or abandoned"""
+        current = threading.current_thread()
+        while True:
+            with self._condition:
+                while self._running and self._thread is current and self._request is None:
+                    self._condition.wait()
+                if not self._running or self._thread is not current:
+                    return
+                request, self._request = self._request, None
+
+            self._open(request)
+            with self._condition:
+                request.done = True
+                self._condition.notify_all()
+                if not request.abandoned:
+                    continue
+
+            logger.info('opened song %s after its deadline', request.filename)
+            if request.error is None:
+                self.blacklist.discard(request.filename)
+                if hasattr(request.source, 'close'):
+                    request.source.close()
+            else:
+                logger.warning('can\'t open song %s: %s', request.filename, request.error)
+                self.blacklist.add(request.filename, request.mtime)
+            # the worker was replaced while it was blocked
+            return
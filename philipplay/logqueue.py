@@ -0,0 +1,180 @@
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+from philipplay import metrics
+
+logger = logging.getLogger(__name__)
+
+DROPPED = metrics.counter('philipplay_log_records_dropped_total', 'Number of log records dropped as the queue was full')
+AGGREGATED = metrics.counter('philipplay_log_records_aggregated_total', 'Number of log records merged into another')
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler which never blocks the logging thread. A record which does not fit into
+    the bounded queue is dropped and counted.
+    """
+    def __init__(self, records):
+        """
+        Initializes a new instance of the :class:`DroppingQueueHandler` class.
+
+        :param queue.Queue records: Bounded queue to hand over the records
+        """
+        super(DroppingQueueHandler, self).__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # the records are handled in the same process, formatting is left to the listener thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            DROPPED.inc()
+
+
+class LogPipeline(object):
+    """
+    Hands over the log records to a background thread, which passes them to the configured handlers.
+
+    The handlers of the root logger are replaced by a :class:`DroppingQueueHandler`, so neither
+    formatting a record nor a slow handler like the systemd journal delays the thread which logs.
+    A run of identical records below :data:`logging.WARNING`, i.e. with the same logger, level, message
+    template and arguments, is passed on at most once per window: the first record right away, the last
+    one along with the number of records it replaces once the window has passed or another record arrives.
+    So no record with other content is held back or reordered.
+    """
+    def __init__(self, **kwargs):
+        """
+        Initializes a new instance of the :class:`LogPipeline` class.
+
+        :param bool log_queue: False to keep logging synchronously
+        :param int log_queue_size: Maximum number of records waiting for the handlers
+        :param int log_repeat_window_ms: Window to merge a run of identical records, 0 to disable
+        """
+        self._enabled = kwargs.get('log_queue', True)
+        self._records = queue.Queue(kwargs.get('log_queue_size', 1000))
+        self._window = kwargs.get('log_repeat_window_ms', 1000) / 1000
+        self._handler = DroppingQueueHandler(self._records)
+        self._handlers = list()
+        # key, first time, latest record and number of merged records of the current run
+        self._repeat = None
+        self._reported = 0
+        self._thread = threading.Thread(target=self._run, name='philipplay-logging', daemon=True)
+
+    def __enter__(self):
+        """Replaces the handlers of the root logger and starts the background thread"""
+        if not self._enabled:
+            return self
+        root = logging.getLogger()
+        self._handlers = list(root.handlers)
+        for handler in self._handlers:
+            root.removeHandler(handler)
+        root.addHandler(self._handler)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Passes on the remaining records and restores the handlers of the root logger"""
+        if not self._enabled:
+            return
+        root = logging.getLogger()
+        root.removeHandler(self._handler)
+        self._records.put(None)
+        self._thread.join()
+        for handler in self._handlers:
+            root.addHandler(handler)
+
+    def _run(self):
+        """Passes the queued records on to the handlers"""
+        while True:
+            try:
+                record = self._records.get(timeout=self._timeout())
+            except queue.Empty:
+                self._flush(time.time())
+                continue
+
+            self._report_dropped()
+            if record is None:
+                self._flush(None)
+                return
+            if not self._merge(record):
+                self._flush(None)
+                self._handle(record)
+                self._start_run(record)
+
+    def _timeout(self):
+        """Gets the time until the next window has passed, None if there is no window"""
+        if self._repeat is None:
+            return None
+        return max(0., self._repeat[1] + self._window - time.time())
+
+    def _merge(self, record):
+        """
+        Merges a record into the current run of identical records, if it is within the window.
+
+        :return: True if the record was merged and must not be handled now
+        """
+        repeat = self._repeat
+        if repeat is None or record.created - repeat[1] >= self._window:
+            return False
+        try:
+            if self._key(record) != repeat[0]:
+                return False
+        except TypeError:
+            return False  # the arguments can't be compared
+        repeat[2] = record
+        repeat[3] += 1
+        return True
+
+    def _start_run(self, record):
+        """Starts a run of identical records with a record which was handled, if it may be merged"""
+        if self._window <= 0 or record.levelno >= logging.WARNING:
+            return
+        try:
+            self._repeat = [self._key(record), record.created, None, 0]
+        except TypeError:
+            pass  # the arguments can't be compared
+
+    @staticmethod
+    def _key(record):
+        """Gets the key of identical records"""
+        key = (record.name, record.levelno, record.msg, record.args)
+        hash(key)
+        return key
+
+    def _flush(self, now):
+        """Handles the latest record of the current run once its window has passed, right away if `now` is None"""
+        repeat = self._repeat
+        if repeat is None or (now is not None and now - repeat[1] < self._window):
+            return
+        self._repeat = None
+        _, _, record, count = repeat
+        if record is None:
+            return
+        AGGREGATED.inc(count - 1)
+        if count > 1:
+            record.msg, record.args = '%s (%s identical records)', (record.getMessage(), count)
+        self._handle(record)
+
+    def _report_dropped(self):
+        """Logs the number of dropped records, once there is room in the queue again"""
+        dropped = self._handler.dropped
+        if dropped == self._reported:
+            return
+        record = logger.makeRecord(logger.name, logging.WARNING, __file__, 0,
+                                   'dropped %s log records, the log queue was full', (dropped - self._reported,), None)
+        self._reported = dropped
+        self._flush(None)
+        self._handle(record)
+
+    def _handle(self, record):
+        """Passes a record on to the configured handlers"""
+        for handler in self._handlers:
+            if record.levelno >= handler.level:
+                handler.handle(record)
@@ -0,0 +1,191 @@
+import io
+import logging
+import os
+import threading
+
+from philipplay.index import base_paths, cache_paths, load_cache, save_cache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+LOUDNESS_VERSION = 1
+LOUDNESS_FILE = '.philipplay-loudness.json'
+
+# number of samples analyzed at once, bounds the memory of the temporary float arrays
+BLOCK_SIZE = 1 << 16
+
+
+def analyze(samples, target=.1, max_gain=4.):
+    """
+    Computes the RMS and peak level of decoded audio samples and the gain to reach the target level.
+
+    :param numpy.ndarray samples: Signed integer samples, one column per channel
+    :param float target: Target RMS level relative to full scale
+    :param float max_gain: Maximum gain applied to quiet songs
+    :return: Tuple of the gain, the RMS level and the peak level, levels relative to full scale
+    """
+    samples = samples.reshape(-1)
+    if not samples.size:
+        return 1., 0., 0.
+
+    full_scale = float(numpy.iinfo(samples.dtype).max) if samples.dtype.kind == 'i' else 1.
+    squares = 0.
+    peak = 0.
+    for start in range(0, samples.size, BLOCK_SIZE):
+        block = samples[start:start + BLOCK_SIZE].astype(numpy.float32)
+        squares += float(numpy.dot(block, block))
+        peak = max(peak, float(numpy.abs(block).max()))
+
+    rms = (squares / samples.size) ** .5 / full_scale
+    peak /= full_scale
+    if rms <= 0:
+        return 1., rms, peak
+
+    # never amplify a song beyond its peak, that would clip it
+    gain = min(target / rms, max_gain, 1. / peak if peak > 0 else max_gain)
+    return gain, rms, peak
+
+
+def decode(path, limit=None):
+    """
+    Decodes the beginning of an audio file with the pygame mixer, which needs to be initialized.
+
+    :param str path: Path of the audio file
+    :param int limit: Number of bytes of the file to decode, None to decode the whole file. The mixer
+        decodes into memory at once, so the limit bounds the memory of the decoded samples.
+    """
+    import pygame.sndarray
+    from pygame import mixer
+    with open(path, 'rb') as audio_file:
+        data = audio_file.read(-1 if limit is None else limit)
+    return pygame.sndarray.samples(mixer.Sound(file=io.BytesIO(data)))
+
+
+class LoudnessAnalyzer(object):
+    """
+    Analyzes the loudness of songs in a background thread and caches the gain of every song.
+
+    The gain is cached by the path, size and modification time of every song next to the
+    library index, so every song is only decoded once. A song which can't be decoded is cached
+    with a gain of 1.0, so it is not decoded again until it is modified.
+    """
+    def __init__(self, **kwargs):
+        """
+        Initializes a new instance of the :class:`LoudnessAnalyzer` class.
+
+        :param base_path: Root directory of the song library, or a list of root directories.
+            The cache is stored with the first root directory.
+        :param float loudness_target: Target RMS level relative to full scale
+        :param int loudness_analyze_bytes: Number of bytes analyzed from the beginning of every song,
+            the decoded samples take about ten times as much memory for common bit rates
+        :param str loudness_path: Path of the loudness cache file (see :func:`philipplay.index.cache_paths`)
+        """
+        self._base_path = base_paths(kwargs.get('base_path', '~/Music'))[0]
+        self._target = kwargs.get('loudness_target', .1)
+        self._limit = kwargs.get('loudness_analyze_bytes', 1024 * 1024)
+        self._paths = cache_paths(self._base_path, LOUDNESS_FILE, kwargs.get('loudness_path'))
+        self._entries = dict()
+        self._wanted = list()
+        self._dirty = False
+        self._running = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='philipplay-loudness', daemon=True)
+
+    def start(self):
+        """Loads the loudness cache and starts the background thread"""
+        if numpy is None:
+            logger.warning('numpy is not installed, loudness analysis is disabled')
+            return
+        self._load()
+        self._running = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread and saves the loudness cache"""
+        if not self._running:
+            return
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+        self._save()
+
+    def gain(self, song, stat):
+        """
+        Gets the cached gain of a song, 1.0 if the song was not analyzed yet or has changed since.
+
+        :param str song: Absolute path of the song
+        :param tuple stat: Size and modification time in nanoseconds of the song, as it was opened to be
+            played, so getting the gain does not access the file system
+        """
+        entry = self._entries.get(song)
+        if not entry:
+            return 1.
+        if tuple(stat) != (entry['size'], entry['mtime']):
+            with self._condition:
+                self._entries.pop(song, None)
+            return 1.
+        return entry['gain']
+
+    def submit(self, songs):
+        """
+        Analyzes the given songs in the background, songs already analyzed are skipped.
+
+        :param list songs: Absolute paths of the songs, most important first
+        """
+        if not self._running:
+            return
+        with self._condition:
+            self._wanted = [song for song in songs if song not in self._entries]
+            self._condition.notify()
+
+    def _run(self):
+        """Decodes and analyzes the wanted songs"""
+        while True:
+            with self._condition:
+                while self._running and not self._wanted:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                song = self._wanted.pop(0)
+
+            try:
+                stat = os.stat(song)
+            except OSError:
+                continue
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+            try:
+                gain, rms, peak = analyze(decode(song, self._limit), self._target)
+                entry.update(gain=gain, rms=rms, peak=peak)
+                logger.debug('song %s has rms %.3f, peak %.3f, gain %.2f', song, rms, peak, gain)
+            except Exception as ex:
+                logger.debug('can\'t analyze loudness of %s: %s', song, ex)
+                entry.update(gain=1., failed=True)
+
+            with self._condition:
+                self._entries[song] = entry
+                self._dirty = True
+                idle = not self._wanted
+            if idle:
+                self._save()
+
+    def _load(self):
+        """Loads the loudness cache from the first readable cache file"""
+        _, entries = load_cache(self._paths, LOUDNESS_VERSION, self._base_path)
+        if entries is not None:
+            self._entries = entries
+
+    def _save(self):
+        """Writes the loudness cache to the first writable cache file if it has changed"""
+        with self._condition:
+            if not self._dirty:
+                return
+            entries = dict(self._entries)
+            self._dirty = False
+
+        if save_cache(self._paths, LOUDNESS_VERSION, self._base_path, entries) is None:
+            logger.warning('loudness cache could not be saved')
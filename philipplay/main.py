@@ -3,57 +3,152 @@ import argparse
 import logging
 import logging.config
 import signal
+import sys
 import threading
+import time
 
 import os
-import pygame
-import yaml
-
-from philipplay.controller import Controller
-from philipplay.library import Library
-from philipplay.player import Player
 
 logger = logging.getLogger('philipplay')
 shutdown = threading.Event()
 
 
+class StartupProfile(object):
+    """Measures the duration of the startup phases"""
+    def __init__(self):
+        self._started = time.perf_counter()
+        self._last = self._started
+        self._phases = list()
+
+    def mark(self, phase):
+        """Ends a phase which started at the end of the previous phase"""
+        now = time.perf_counter()
+        self._phases.append((phase, self._last - self._started, now - self._last))
+        self._last = now
+
+    def record(self, phase, started, ended):
+        """Records a phase which ran concurrently to the other phases"""
+        self._phases.append((phase, started - self._started, ended - started))
+
+    def report(self, stream=sys.stderr):
+        """Prints the start offset and the duration of every phase"""
+        stream.write('startup profile:\n')
+        for phase, offset, duration in sorted(self._phases, key=lambda p: p[1]):
+            stream.write('  %-24s at %7.1f ms took %7.1f ms\n' % (phase, offset * 1000, duration * 1000))
+        stream.flush()
+
+
 # noinspection PyUnusedLocal
 def signal_handler(signal_number, frame):
     """Signal handler to intercept SIGINT"""
     shutdown.set()
 
 
+# noinspection PyUnusedLocal
+def dump_metrics(signal_number, frame):
+    """Signal handler to log all metrics on SIGUSR1"""
+    from philipplay import metrics
+    logger.info('metrics:\n%s', metrics.render())
+
+
 def setup_parser():
     """Setup the command line argument parser"""
     parser = argparse.ArgumentParser()
     parser.add_argument('-c', '--config', help='Path to the configuration file')
+    parser.add_argument('--startup-profile', action='store_true', help='Print the duration of the startup phases')
+    parser.add_argument('--record-trace', metavar='PATH',
+                        help='Record key presses, file system events and player transitions to a trace, '
+                             'which can be replayed by benchmarks/replay_trace.py')
     return parser
 
 
 def setup_environment():
-    """Setup the pygame environment"""
+    """
+    Setup the pygame environment. Only the event queue is initialized, the mixer is
+    initialized by the player and no other pygame module is needed.
+    """
     logging.debug('setup pygame environment')
     os.environ['SDL_VIDEODRIVER'] = 'dummy'
-    pygame.init()
+    import pygame
     pygame.display.init()
-    pygame.display.set_mode((1, 1))
     signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGUSR1, dump_metrics)
 
 
 def parse_main():
     """The application main entry point"""
     parser = setup_parser()
     args = parser.parse_args().__dict__
+    profile = StartupProfile()
     config_path = args.get('config', None) or '/etc/philipplay.yaml'
+
+    import yaml
     with open(config_path, 'r') as config_file:
-        config, log_config = yaml.load_all(config_file)
+        # the configuration refers to python objects, the C loader is used if available as it is faster
+        config, log_config = yaml.load_all(config_file, Loader=getattr(yaml, 'CLoader', yaml.Loader))
     logging.config.dictConfig(log_config)
+    profile.mark('configuration')
+
+    # the handlers are called by a background thread, a slow handler doesn't delay the player
+    from philipplay.logqueue import LogPipeline
+    with LogPipeline(**config):
+        trace = None
+        if args.get('record_trace'):
+            from philipplay.trace import TraceRecorder
+            trace = TraceRecorder(args['record_trace'])
+            trace.start()
+        try:
+            run(dict(config, trace=trace), args, profile)
+        finally:
+            if trace is not None:
+                trace.stop()
+
+
+def run(config, args, profile):
+    """Runs the audio player until it is shut down"""
+    # with the asyncio runtime, the controller runs on an event loop in the main thread
+    loop = None
+    if config.get('runtime', 'threads') == 'asyncio':
+        import asyncio
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+    # the library is scanned in the background while pygame and the mixer are initialized
+    from philipplay.library import Library
+    profile.mark('import library')
+    scan_started = time.perf_counter()
+    with Library(loop=loop, **config) as library:
+        profile.mark('start library')
+        setup_environment()
+        profile.mark('initialize pygame')
+        from philipplay import metrics
+        from philipplay.controller import AsyncController, Controller
+        from philipplay.player import Player
+        profile.mark('import player')
+
+        with metrics.MetricsServer(**config), Player(**config) as player:
+            profile.mark('initialize mixer')
+            if loop is not None:
+                controller = AsyncController(player, library, event=shutdown, loop=loop, **config)
+            else:
+                controller = Controller(player, library, event=shutdown, **config)
+            with controller:
+                profile.mark('start controller')
+                logger.info('Press Q to shutdown')
+                if args.get('startup_profile'):
+                    def report():
+                        library.ready.wait()
+                        profile.record('scan library', scan_started, library.ready_at)
+                        profile.report()
+                    threading.Thread(target=report, name='philipplay-profile', daemon=True).start()
+                if loop is not None:
+                    controller.run_forever()
+                else:
+                    shutdown.wait()
+                logger.info('Shutting down audio player')
 
-    setup_environment()
-    with Player(**config) as player, Library(**config) as library, Controller(player, library, event=shutdown):
-        logger.info('Press Q to shutdown')
-        shutdown.wait()
-        logger.info('Shutting down audio player')
+    if loop is not None:
+        loop.close()
 
 
 if __name__ == '__main__':
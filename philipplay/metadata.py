@@ -0,0 +1,198 @@
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import re
+import sys
+import threading
+
+from philipplay.index import cache_paths, load_cache, save_cache
+
+try:
+    import mutagen
+except ImportError:
+    mutagen = None
+
+logger = logging.getLogger(__name__)
+
+METADATA_VERSION = 1
+METADATA_FILE = '.philipplay-metadata.json'
+
+
+def _track_number(value):
+    """Parses a track number like '3' or '3/12'"""
+    match = re.match(r'\s*(\d+)', str(value or ''))
+    return int(match.group(1)) if match else None
+
+
+def read_metadata(path):
+    """
+    Reads the tags and the duration of an audio file. Without mutagen, only the track
+    number is taken from a leading number in the file name.
+
+    :param str path: Absolute path to the audio file
+    :return: Dictionary with the track number, duration, title, artist and album
+    """
+    metadata = {
+        'track': _track_number(os.path.basename(path)),
+        'duration': None,
+        'title': None,
+        'artist': None,
+        'album': None,
+    }
+    if mutagen is None:
+        return metadata
+
+    try:
+        audio = mutagen.File(path, easy=True)
+    except Exception as ex:
+        logger.debug('can\'t read tags of %s: %s', path, ex)
+        return metadata
+    if audio is None:
+        return metadata
+
+    tags = audio.tags or {}
+    for name in ('title', 'artist', 'album'):
+        values = tags.get(name)
+        metadata[name] = values[0] if values else None
+    track = _track_number((tags.get('tracknumber') or [None])[0])
+    if track is not None:
+        metadata['track'] = track
+    if getattr(audio, 'info', None) is not None:
+        metadata['duration'] = getattr(audio.info, 'length', None)
+    return metadata
+
+
+def read_directory_metadata(songs):
+    """
+    Reads the metadata of all new or changed songs of a song directory, runs in a worker process.
+
+    :param list songs: Tuples of the path, and the size and modification time of the cached metadata
+    :return: List of tuples with the path, size, modification time and metadata of every changed song
+    """
+    results = list()
+    for path, size, mtime in songs:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if (stat.st_size, stat.st_mtime_ns) == (size, mtime):
+            continue
+        results.append((path, stat.st_size, stat.st_mtime_ns, read_metadata(path)))
+    return results
+
+
+class MetadataIndexer(object):
+    """
+    Reads the metadata of songs in a pool of worker processes.
+
+    The metadata is cached by the path, size and modification time of every song. Songs
+    are submitted per song directory and never block the caller, the :attr:`on_indexed`
+    callback is called from a worker thread once the metadata of a directory is known.
+    """
+    def __init__(self, **kwargs):
+        """
+        Initializes a new instance of the :class:`MetadataIndexer` class.
+
+        :param str base_path: Root directory of the song library
+        :param int metadata_workers: Number of worker processes, defaults to the number of CPUs
+        :param str metadata_path: Path of the metadata cache file (see :func:`philipplay.index.cache_paths`)
+        """
+        base_path = kwargs['base_path']
+        self._base_path = base_path
+        self._workers = kwargs.get('metadata_workers') or os.cpu_count() or 1
+        self._paths = cache_paths(base_path, METADATA_FILE, kwargs.get('metadata_path'))
+        self._entries = dict()
+        self._pending = 0
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._executor = None
+        self.on_indexed = lambda *a, **kw: None
+
+    def start(self):
+        """Loads the metadata cache and starts the worker processes"""
+        self._load()
+        options = dict()
+        if sys.version_info >= (3, 7):
+            # forking a process with running threads can deadlock the worker processes
+            options['mp_context'] = multiprocessing.get_context('forkserver')
+        self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self._workers, **options)
+
+    def stop(self):
+        """Stops the worker processes and saves the metadata cache"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        self._save()
+
+    def get(self, song):
+        """
+        Gets the cached metadata of a song.
+
+        :return: The metadata dictionary (see :func:`read_metadata`), or None if it is not known yet
+        """
+        entry = self._entries.get(song)
+        return entry['metadata'] if entry else None
+
+    def submit(self, directory, songs):
+        """
+        Reads the metadata of new or changed songs of a song directory in the background.
+
+        :param str directory: Song directory the songs belong to
+        :param list songs: Absolute paths of the songs
+        """
+        if self._executor is None:
+            return
+
+        with self._lock:
+            known = [(song,) + self._known(song) for song in songs]
+            self._pending += 1
+        future = self._executor.submit(read_directory_metadata, known)
+        future.add_done_callback(lambda f: self._on_done(directory, f))
+
+    def _known(self, song):
+        """Gets the size and modification time of the cached metadata of a song"""
+        entry = self._entries.get(song)
+        return (entry['size'], entry['mtime']) if entry else (None, None)
+
+    def _on_done(self, directory, future):
+        """Stores the metadata read by a worker process"""
+        try:
+            results = future.result()
+        except concurrent.futures.CancelledError:
+            # a BaseException since Python 3.8, raised once the worker processes were shut down
+            logger.debug('reading metadata of %s was cancelled', directory)
+            results = list()
+        except Exception as ex:
+            logger.warning('can\'t read metadata of %s: %s', directory, ex)
+            results = list()
+
+        with self._lock:
+            for path, size, mtime, metadata in results:
+                self._entries[path] = {'size': size, 'mtime': mtime, 'metadata': metadata}
+            self._dirty = self._dirty or bool(results)
+            self._pending -= 1
+            idle = self._pending == 0
+
+        if results:
+            logger.debug('read metadata of %s songs in %s', len(results), directory)
+            self.on_indexed(directory)
+        if idle:
+            self._save()
+
+    def _load(self):
+        """Loads the metadata cache from the first readable cache file"""
+        _, entries = load_cache(self._paths, METADATA_VERSION, self._base_path)
+        if entries is not None:
+            self._entries = entries
+
+    def _save(self):
+        """Writes the metadata cache to the first writable cache file if it has changed"""
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = dict(self._entries)
+            self._dirty = False
+
+        if save_cache(self._paths, METADATA_VERSION, self._base_path, entries) is None:
+            logger.warning('metadata cache could not be saved')
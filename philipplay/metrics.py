@@ -0,0 +1,211 @@
+import bisect
+import http.server
+import logging
+import os
+import socketserver
+import threading
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds, from a key press handled within a millisecond to a cold library scan
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+
+class Counter(object):
+    """Monotonic counter, e.g. the number of key presses"""
+    kind = 'counter'
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        """Increments the counter"""
+        with self._lock:
+            self._value += amount
+
+    @property
+    def value(self):
+        return self._value
+
+    def samples(self):
+        """Gets the samples of the metric as tuples of the name, the labels and the value"""
+        return [(self.name, '', self._value)]
+
+
+class Gauge(Counter):
+    """Value which can go up and down, e.g. the number of pending events"""
+    kind = 'gauge'
+
+    def set(self, value):
+        """Sets the value of the gauge"""
+        self._value = value
+
+
+class Histogram(object):
+    """Distribution of observed values, e.g. durations, counted in cumulative buckets"""
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self._bounds = tuple(sorted(buckets))
+        self._counts = [0] * (len(self._bounds) + 1)
+        self._sum = 0.
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Adds an observed value to the distribution"""
+        index = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+            self._count += 1
+
+    @property
+    def count(self):
+        return self._count
+
+    def samples(self):
+        """Gets the samples of the metric as tuples of the name, the labels and the value"""
+        with self._lock:
+            counts, total, count = list(self._counts), self._sum, self._count
+
+        samples = list()
+        cumulative = 0
+        for bound, bucket in zip(self._bounds + (float('inf'),), counts):
+            cumulative += bucket
+            label = '+Inf' if bound == float('inf') else repr(float(bound))
+            samples.append((self.name + '_bucket', '{le="%s"}' % label, cumulative))
+        samples.append((self.name + '_sum', '', total))
+        samples.append((self.name + '_count', '', count))
+        return samples
+
+
+class Registry(object):
+    """Collection of all metrics of the application"""
+    def __init__(self):
+        self._metrics = dict()
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """Registers a metric, a metric registered before under the same name is returned instead"""
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        """Renders all metrics in the Prometheus text exposition format"""
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+
+        lines = list()
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.description))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, description):
+    """Gets the counter with the given name from the default registry"""
+    return REGISTRY.register(Counter(name, description))
+
+
+def gauge(name, description):
+    """Gets the gauge with the given name from the default registry"""
+    return REGISTRY.register(Gauge(name, description))
+
+
+def histogram(name, description, buckets=DEFAULT_BUCKETS):
+    """Gets the histogram with the given name from the default registry"""
+    return REGISTRY.register(Histogram(name, description, buckets))
+
+
+def render():
+    """Renders all metrics of the default registry in the Prometheus text exposition format"""
+    return REGISTRY.render()
+
+
+class _MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the metrics of the default registry on every GET request"""
+    def do_GET(self):
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # noinspection PyShadowingBuiltins
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class _TCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class MetricsServer(object):
+    """
+    Exports the metrics of the default registry over HTTP, to be scraped by Prometheus
+    or read with ``curl`` (``curl --unix-socket`` for a UNIX socket).
+    """
+    def __init__(self, **kwargs):
+        """
+        Initializes a new instance of the :class:`MetricsServer` class.
+
+        :param str metrics_address: Address to listen on, either 'host:port' or 'unix:/path/to/socket'.
+            The metrics are not exported if not set
+        """
+        self._address = kwargs.get('metrics_address')
+        self._server = None
+        self._thread = None
+
+    def __enter__(self):
+        """Starts listening for requests in a background thread"""
+        if not self._address:
+            return self
+
+        try:
+            if self._address.startswith('unix:'):
+                path = self._address[len('unix:'):]
+                if os.path.exists(path):
+                    os.remove(path)
+                self._server = _UnixServer(path, _MetricsHandler)
+            else:
+                host, _, port = self._address.rpartition(':')
+                self._server = _TCPServer((host or 'localhost', int(port)), _MetricsHandler)
+        except (OSError, ValueError) as ex:
+            logger.warning('can\'t export metrics on %s: %s', self._address, ex)
+            return self
+
+        logger.info('export metrics on %s', self._address)
+        self._thread = threading.Thread(target=self._server.serve_forever, name='philipplay-metrics', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        """Stops listening for requests"""
+        if self._server is None:
+            return
+
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        if self._address.startswith('unix:'):
+            try:
+                os.remove(self._address[len('unix:'):])
+            except OSError:
+                pass
@@ -0,0 +1,114 @@
+import logging
+import os
+import re
+import select
+import threading
+
+from philipplay import metrics
+
+logger = logging.getLogger(__name__)
+
+MOUNT_CHANGES = metrics.counter('philipplay_mount_changes_total', 'Number of changes of the mount table')
+
+# mount points escape spaces, tabs, new lines and backslashes as octal numbers
+ESCAPED = re.compile(r'\\([0-7]{3})')
+
+
+def parse_mountinfo(content):
+    """
+    Parses the content of a mountinfo file (see proc(5)).
+
+    :param str content: Content of the mountinfo file
+    :return: Dictionary of the mount id by the mount point
+    """
+    mounts = dict()
+    for line in content.splitlines():
+        fields = line.split(' ')
+        if len(fields) < 5:
+            continue
+        mount_point = ESCAPED.sub(lambda match: chr(int(match.group(1), 8)), fields[4])
+        mounts[mount_point] = fields[0]
+    return mounts
+
+
+class MountWatcher(object):
+    """
+    Watches the mount table of the system in a background thread.
+
+    The kernel signals a change of the mount table as an exceptional condition of the
+    mountinfo file, so the thread sleeps in :func:`select.epoll` until a file system was
+    mounted or unmounted and never polls. Only Linux supports this, the watcher is disabled
+    on other systems.
+    """
+    def __init__(self, **kwargs):
+        """
+        Initializes a new instance of the :class:`MountWatcher` class.
+
+        :param str mountinfo_path: Path of the mountinfo file
+        """
+        self._path = kwargs.get('mountinfo_path', '/proc/self/mountinfo')
+        self._file = None
+        self._epoll = None
+        self._wakeup_reader = None
+        self._wakeup_writer = None
+        self._thread = threading.Thread(target=self._run, name='philipplay-mounts', daemon=True)
+        self.mounts = dict()
+        # called from the background thread with the mount ids by mount point whenever the mount table has changed
+        self.on_changed = lambda *a, **kw: None
+
+    def start(self):
+        """
+        Reads the current mount table and starts watching it.
+
+        :return: The mount ids by mount point, empty if the mount table can't be watched
+        """
+        if not hasattr(select, 'epoll'):
+            logger.warning('mount table can\'t be watched on this system')
+            return self.mounts
+        try:
+            self._file = open(self._path, 'r')
+            self.mounts = parse_mountinfo(self._file.read())
+        except OSError as ex:
+            logger.warning('can\'t watch mount table %s: %s', self._path, ex)
+            return self.mounts
+
+        self._wakeup_reader, self._wakeup_writer = os.pipe()
+        self._epoll = select.epoll()
+        self._epoll.register(self._file.fileno(), select.EPOLLPRI | select.EPOLLERR)
+        self._epoll.register(self._wakeup_reader, select.EPOLLIN)
+        self._thread.start()
+        return self.mounts
+
+    def stop(self):
+        """Stops watching the mount table"""
+        if self._epoll is None:
+            return
+        os.write(self._wakeup_writer, b'\0')
+        self._thread.join()
+        self._epoll.close()
+        self._file.close()
+        os.close(self._wakeup_reader)
+        os.close(self._wakeup_writer)
+        self._epoll = None
+
+    def _run(self):
+        """Reads the mount table again whenever the kernel signals a change"""
+        while True:
+            events = self._epoll.poll()
+            if any(fd == self._wakeup_reader for fd, _ in events):
+                return
+
+            # reading the file from its start acknowledges the change
+            self._file.seek(0)
+            mounts = parse_mountinfo(self._file.read())
+            if mounts == self.mounts:
+                continue
+
+            MOUNT_CHANGES.inc()
+            logger.debug('mount table changed: %s mounted, %s unmounted',
+                         sorted(set(mounts) - set(self.mounts)), sorted(set(self.mounts) - set(mounts)))
+            self.mounts = mounts
+            try:
+                self.on_changed(mounts)
+            except Exception as ex:
+                logger.error('can\'t handle change of the mount table: %s', ex)
@@ -1,81 +1,459 @@
 import logging
+import os
+import threading
 import time
 
 import pygame
 from pygame import mixer
 
+from philipplay import metrics
+from philipplay.cache import HeadCache, HeadFile
+from philipplay.loader import SIGNATURE_BYTES, SongLoader, check_signature
+from philipplay.loudness import LoudnessAnalyzer
+from philipplay.staging import Stager
+
 logger = logging.getLogger(__name__)
 
+SONGS_STARTED = metrics.counter('philipplay_songs_started_total', 'Number of songs started')
+STOPS = metrics.counter('philipplay_stops_total', 'Number of times the player was stopped')
+KEY_TO_AUDIO = metrics.histogram('philipplay_key_to_audio_seconds', 'Time from a key press until the song is played')
+FADE = metrics.histogram('philipplay_fade_seconds', 'Time from the start of a fade out until the song has stopped')
+
 
 NEXT_SONG = pygame.USEREVENT + 1
 STOP = pygame.USEREVENT + 2
 
+IDLE = 'idle'
+PLAYING = 'playing'
+FADING = 'fading'
+
 
 # noinspection PyArgumentList
 class Player(object):
     """
     Simple audio player which used `pygame.mixer` to play audio files.
+
+    The player never waits for a fade out. A fade out switches the player into the fading
+    state, the mixer posts the :data:`STOP` event once the fade out has completed, which
+    has to be passed to :meth:`Player.fade_complete` by the event loop.
     """
     def __init__(self, **kwargs):
         """
         Initializes a new instance of the :class:`Player` class.
 
         :param float fadeout: Fadeout time in seconds when switch to next song
+        :param bool prefetch: Queue the next song while the current song is played to switch without gap
+        :param int head_cache_bytes: Memory budget to cache the first bytes of the songs to start instantly,
+            0 to disable the cache (see :class:`philipplay.cache.HeadCache`)
+        :param int staging_bytes: Memory budget to stage the songs of the active song library,
+            0 to disable staging (see :class:`philipplay.staging.Stager`)
+        :param bool normalize: Adjust the volume of every song by its analyzed loudness
+            (see :class:`philipplay.loudness.LoudnessAnalyzer`)
+        :param float gapless_gain_tolerance: Largest relative difference between the loudness gains of the
+            current and the next song to queue the next song, None to queue every song. The mixer starts a
+            queued song at the volume of the current song, its own gain is applied once the controller
+            noticed the switch, up to `end_poll_ms` later. A song which is not queued is loaded once the
+            current song has ended, after a gap of up to `end_poll_ms`
+        :param int load_deadline_ms: Time to wait for a song to be opened and validated, a song which misses
+            it is skipped (see :class:`philipplay.loader.SongLoader`)
+        :param int head_bytes: Number of bytes of a song which are read before it is loaded into the mixer,
+            so the mixer reads the headers of the song from memory
+        :param philipplay.trace.TraceRecorder trace: Recorder of the transitions of the player, if set
+        :param int volume_tick_ms: Interval to move the volume towards its target (see :meth:`ramp`)
+        :param float volume_ramp: Maximum change of the volume per second
         """
         self._fadeout = int(kwargs.get('fadeout', .5) * 1000)
+        self._prefetch = kwargs.get('prefetch', True)
+        self._queued = None
+        self._queued_gain = 1.
+        self._gain_tolerance = kwargs.get('gapless_gain_tolerance')
+        self._state = IDLE
+        self._song = None
+        self._pending = None
+        self._fade_started = 0
+        self._lock = threading.RLock()
+        self._cache = HeadCache(**kwargs) if kwargs.get('head_cache_bytes', 1) > 0 else None
+        self._stager = Stager(**kwargs) if kwargs.get('staging_bytes', 1) > 0 else None
+        self._loudness = LoudnessAnalyzer(**kwargs) if kwargs.get('normalize', True) else None
+        self._loader = SongLoader(**kwargs)
+        self._head_bytes = kwargs.get('head_bytes', 256 * 1024)
+        self._trace = kwargs.get('trace')
+        self._volume = 1.
+        self._target = 1.
+        self._tick = kwargs.get('volume_tick_ms', 20) / 1000
+        self._ramp_step = kwargs.get('volume_ramp', 2.) * self._tick
+        self._ramped = 0
+        self._gain = 1.
+        self._requested = None
+        # called with the path of a song which was skipped as it can't be played
+        self.on_failed = lambda *a, **kw: None
+        self._offset = 0.
+        self._song_started = 0
 
     @property
     def volume(self):
         """Gets the current volume of the audio player"""
-        return mixer.music.get_volume()
+        return self._volume
 
     @volume.setter
     def volume(self, value):
         """Sets the volume of the audio player"""
         value = min(1, max(0, value))
         logger.info('set volume %s', value)
-        mixer.music.set_volume(value)
+        self._volume = value
+        self._target = value
+        mixer.music.set_volume(min(1, self._volume * self._gain))
+
+    def ramp(self, step):
+        """
+        Changes the target volume. The volume approaches the target by :meth:`update_volume`,
+        so the mixer is changed at a fixed rate no matter how often the target changes.
+
+        :param float step: Change of the target volume
+        """
+        self._target = round(min(1, max(0, self._target + step)), 3)
+
+    def update_volume(self):
+        """
+        Moves the volume towards its target, at most once per tick.
+
+        :return: Time in seconds until the volume needs to be updated again, None if it has reached its target
+        """
+        if self._volume == self._target:
+            return None
+        now = time.perf_counter()
+        wait = self._ramped + self._tick - now
+        if wait > 0:
+            return wait
+
+        self._ramped = now
+        if abs(self._target - self._volume) <= self._ramp_step:
+            self._volume = self._target
+        else:
+            self._volume += self._ramp_step if self._target > self._volume else -self._ramp_step
+        mixer.music.set_volume(min(1, self._volume * self._gain))
+        if self._volume == self._target:
+            logger.info('set volume %s', self._volume)
+            return None
+        return self._tick
+
+    def _song_gain(self, filename):
+        """Gets the cached loudness gain of a song which was just opened by the loader"""
+        if not self._loudness:
+            return 1.
+        stat = self._loader.stat(filename)
+        return self._loudness.gain(filename, stat) if stat else 1.
+
+    def _apply_gain(self, gain):
+        """Applies a loudness gain to the mixer volume"""
+        self._gain = gain
+        mixer.music.set_volume(min(1, self._volume * self._gain))
 
     def __enter__(self):
         """Setup the system to allow playing of audio files"""
         mixer.init()
+        self._loader.start()
+        if self._cache:
+            self._cache.start()
+        if self._stager:
+            self._stager.start()
+        if self._loudness:
+            self._loudness.start()
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """Stops the audio player, and terminates all related threads"""
-        self.stop()
+        with self._lock:
+            self._pending = None
+            self._halt()
         mixer.quit()
+        self._loader.stop()
+        if self._cache:
+            self._cache.stop()
+        if self._stager:
+            self._stager.stop()
+        if self._loudness:
+            self._loudness.stop()
+
+    @property
+    def position(self):
+        """Gets the playback position of the current song in seconds, 0 if no song is played"""
+        if self._state != PLAYING:
+            return 0.
+        return time.perf_counter() - self._song_started
+
+    @property
+    def fade_remaining(self):
+        """Gets the time in seconds until the current fade out has completed, 0 if no song is faded out"""
+        if self._state != FADING:
+            return 0.
+        return max(0., self._fadeout / 1000 - (time.perf_counter() - self._fade_started))
+
+    @property
+    def blacklist(self):
+        """Gets the songs which are skipped as they can't be played (see :class:`philipplay.loader.Blacklist`)"""
+        return self._loader.blacklist
+
+    @property
+    def song(self):
+        """Gets the song which is played or faded out, None if the player is idle"""
+        return self._song
 
-    def play(self, filename):
+    @property
+    def state(self):
+        """Gets the state of the audio player, one of :data:`IDLE`, :data:`PLAYING` or :data:`FADING`"""
+        return self._state
+
+    def play(self, filename, requested=None, offset=0.):
         """
-        Plays the given file. If another file is currently played,
-        the song will be faded out before the new song is started
+        Plays the given file. If another file is currently played, the song will be faded out
+        and the new song is started as soon as the fade out has completed. Playing another
+        file during a fade out replaces the song to be started.
 
         :param str filename: Absolute path to the audio file to be played
+        :param float requested: Time the song was requested by a key press (:func:`time.perf_counter`),
+            to measure the latency until the song is played
+        :param float offset: Position in seconds to start the song at
         """
-        self.stop()
+        with self._lock:
+            self._requested = requested
+            self._offset = offset
+            if self._state == FADING and mixer.music.get_busy():
+                logger.debug('retarget fade out to %s', filename)
+                self._pending = filename
+                return
+
+            if self._state == PLAYING and mixer.music.get_busy():
+                self._pending = filename
+                self._fade()
+                return
+
+            self._halt()
+            self._start(filename)
+
+    def _start(self, filename):
+        """Loads the file and starts playing it right away"""
         if not filename:
             return
 
         logger.info('play song %s', filename)
-        mixer.music.set_endevent(NEXT_SONG)
-        try:
-            mixer.music.load(filename)
-            mixer.music.play()
-        except pygame.error:
-            self.stop()
-
-    def stop(self):
-        """Stops any file which is currently played by the audio player"""
-        if not mixer.music.get_busy():
+        source = self._loader.load(filename, self._prepare)
+        if source is not None:
+            mixer.music.set_endevent(NEXT_SONG)
+            try:
+                self._load(filename, source)
+                self._apply_gain(self._song_gain(filename))
+                self._play(self._offset)
+                self._transition(PLAYING, filename)
+                SONGS_STARTED.inc()
+                if self._requested is not None:
+                    KEY_TO_AUDIO.observe(time.perf_counter() - self._requested)
+            except pygame.error as ex:
+                logger.warning('can\'t play song %s: %s', filename, ex)
+                self._loader.reject(filename)
+                source = None
+        if source is None:
+            self._halt()
+            self.on_failed(filename)
+        self._requested = None
+        self._offset = 0.
+
+    def _play(self, offset):
+        """Starts the loaded song at the given position, from the beginning if the format can't seek"""
+        if offset > 0:
+            try:
+                mixer.music.play(0, offset)
+                self._song_started = time.perf_counter() - offset
+                return
+            except pygame.error as ex:
+                logger.warning('can\'t start song at %.1f s: %s', offset, ex)
+        mixer.music.play()
+        self._song_started = time.perf_counter()
+
+    def _resolve(self, filename):
+        """Gets the path of the staged copy of the song, if the song is staged"""
+        return self._stager.resolve(filename) if self._stager else filename
+
+    def _prepare(self, filename):
+        """
+        Opens a song from the staging area, the head cache or the song file and checks its signature,
+        called by the worker of the loader. The head of a song which is neither staged nor cached is
+        read by the worker, so loading the song into the mixer does not touch the device.
+
+        :return: The path of the staged copy, or a :class:`philipplay.cache.HeadFile`
+        """
+        staged = self._resolve(filename)
+        if staged != filename:
+            with open(staged, 'rb') as song_file:
+                check_signature(filename, song_file.read(SIGNATURE_BYTES))
+            return staged
+
+        source = self._cache.open(filename) if self._cache else None
+        if source is None:
+            with open(filename, 'rb') as song_file:
+                head = song_file.read(self._head_bytes)
+                size = os.fstat(song_file.fileno()).st_size
+            source = HeadFile(filename, head, size)
+        check_signature(filename, source.read(SIGNATURE_BYTES))
+        source.seek(0)
+        return source
+
+    def _load(self, filename, source, queue=False):
+        """Loads or queues the source opened by :meth:`_prepare` into the mixer"""
+        load = mixer.music.queue if queue else mixer.music.load
+        if isinstance(source, str):
+            if source != filename:
+                logger.debug('play staged copy %s', source)
+            load(source)
             return
 
+        try:
+            load(source, os.path.splitext(filename)[1][1:])
+        except TypeError:
+            # pygame before 2.0 does not support a name hint
+            source.close()
+            load(filename)
+
+    def warm(self, songs):
+        """
+        Caches the first bytes of the given songs in the background, to start them instantly.
+
+        :param list songs: Absolute paths of the songs, most important first
+        """
+        if self._cache:
+            self._cache.warm(songs)
+
+    def stage(self, directory, songs):
+        """
+        Stages the songs of the active song library and analyzes their loudness in the background.
+
+        :param str directory: Song directory of the active song library
+        :param list songs: Absolute paths of the songs, in the order they are played
+        """
+        if self._stager and directory:
+            self._stager.stage(directory, songs)
+        if self._loudness:
+            self._loudness.submit(songs)
+
+    def invalidate(self, directories=None):
+        """
+        Drops the staged songs of changed song libraries.
+
+        :param directories: Song directories which have changed, None for all song libraries
+        """
+        if self._stager:
+            self._stager.invalidate(directories)
+
+    def queue(self, filename):
+        """
+        Queues the song which is played as soon as the current song ends. The song is opened
+        and prepared by the mixer right away, so the switch does not need to open it.
+
+        The mixer starts a queued song at the volume of the current song, its own loudness gain is applied
+        by :meth:`advance`. A song whose gain differs by more than `gapless_gain_tolerance` from the gain
+        of the current song is not queued, if set.
+
+        :param str filename: Absolute path to the audio file to be played next
+        """
+        with self._lock:
+            self._queued = None
+            if not self._prefetch or not filename or self._state != PLAYING:
+                return
+
+            logger.debug('queue song %s', filename)
+            source = self._loader.load(filename, self._prepare)
+            if source is None:
+                return
+            gain = self._song_gain(filename)
+            if self._gain_tolerance is not None and abs(gain / self._gain - 1) > self._gain_tolerance:
+                logger.debug('do not queue song %s, its gain %.2f differs from %.2f', filename, gain, self._gain)
+                if not isinstance(source, str):
+                    source.close()
+                return
+            try:
+                self._load(filename, source, queue=True)
+                self._queued = filename
+                self._queued_gain = gain
+            except pygame.error as ex:
+                logger.warning('can\'t queue song %s: %s', filename, ex)
+
+    def advance(self, filename):
+        """
+        Called when the current song has ended. If the given song was queued, the mixer
+        already plays it and nothing needs to be loaded.
+
+        :param str filename: Absolute path to the audio file to be played next
+        :return: True if the song is already played, False if it needs to be played
+        """
+        with self._lock:
+            queued, self._queued = self._queued, None
+            if not queued or queued != filename or self._state != PLAYING or not mixer.music.get_busy():
+                return False
+
+            logger.info('play queued song %s without gap', filename)
+            self._transition(PLAYING, filename)
+            self._apply_gain(self._queued_gain)
+            # the position of the mixer is not reset for queued songs, the wall clock is used instead
+            self._song_started = time.perf_counter()
+            SONGS_STARTED.inc()
+            return True
+
+    def stop(self, fade=True):
+        """
+        Stops any file which is currently played by the audio player. The song is faded out
+        without waiting for the fade out to complete, a song waiting for the fade out is dropped.
+
+        :param bool fade: False to stop the song right away, e.g. if its file is no longer available
+        """
+        with self._lock:
+            STOPS.inc()
+            self._pending = None
+            self._requested = None
+            self._offset = 0.
+            if not fade:
+                self._halt()
+            elif self._state == PLAYING and mixer.music.get_busy():
+                self._fade()
+
+    def fade_complete(self):
+        """
+        Completes a fade out, to be called when the :data:`STOP` event was received.
+        If a song was played during the fade out, it is started now.
+
+        :return: True if a song was started
+        """
+        with self._lock:
+            if self._state != FADING:
+                return False
+
+            elapsed = time.perf_counter() - self._fade_started
+            FADE.observe(elapsed)
+            logger.info('song stopped after %.0f ms fade out', elapsed * 1000)
+            pending, self._pending = self._pending, None
+            self._halt()
+            self._start(pending)
+            return self._state == PLAYING
+
+    def _fade(self):
+        """Starts to fade out the current song"""
+        self._queued = None
+        self._transition(FADING)
+        self._fade_started = time.perf_counter()
         mixer.music.set_endevent(STOP)
         logger.debug('fade out song in %s [ms]', self._fadeout)
         mixer.music.fadeout(self._fadeout)
-        while mixer.music.get_busy():
-            time.sleep(.1)
 
+    def _halt(self):
+        """Stops the mixer right away, without posting an end event"""
+        self._queued = None
+        self._transition(IDLE)
+        mixer.music.set_endevent()
         mixer.music.stop()
-        logger.info('song stopped')
 
+    def _transition(self, state, filename=None):
+        """Switches the state of the player, the transition is recorded if a trace is recorded"""
+        if self._trace is not None and (state != self._state or filename is not None):
+            self._trace.transition(state, filename)
+        self._state = state
+        if filename is not None or state == IDLE:
+            self._song = filename
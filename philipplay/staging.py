@@ -0,0 +1,165 @@
+import collections
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Stager(object):
+    """
+    Copies the songs of the active song library to a staging directory in memory (tmpfs),
+    so the songs are not read from the USB stick while they are played.
+
+    A background thread copies the songs in the order they are played. Staged song libraries
+    are evicted least recently used first to stay within the size budget, the active song
+    library is never evicted. The songs are staged in a private directory created below the
+    staging path, only this directory is removed again.
+    """
+    def __init__(self, **kwargs):
+        """
+        Initializes a new instance of the :class:`Stager` class.
+
+        :param str staging_path: Directory to create the private staging directory in, should be located
+            on a tmpfs
+        :param int staging_bytes: Size budget of all staged songs
+        """
+        self._parent = os.path.expanduser(kwargs.get('staging_path', '/dev/shm/philipplay'))
+        self._path = None
+        self._budget = kwargs.get('staging_bytes', 64 * 1024 * 1024)
+        self._folders = collections.OrderedDict()
+        self._size = 0
+        self._active = None
+        self._wanted = list()
+        self._running = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='philipplay-stager', daemon=True)
+
+    def start(self):
+        """Creates the private staging directory and starts the background thread copying the songs"""
+        try:
+            os.makedirs(self._parent, exist_ok=True)
+            self._path = tempfile.mkdtemp(prefix='staging-', dir=self._parent)
+        except OSError as ex:
+            logger.warning('can\'t create staging directory in %s: %s', self._parent, ex)
+            return
+        self._running = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the background thread and removes the private staging directory"""
+        if not self._running:
+            return
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+        shutil.rmtree(self._path, ignore_errors=True)
+
+    def stage(self, directory, songs):
+        """
+        Makes a song library the active one and stages its songs in the background.
+
+        :param str directory: Song directory of the song library
+        :param list songs: Absolute paths of the songs, in the order they are played
+        """
+        with self._condition:
+            self._active = directory
+            folder = self._folders.setdefault(directory, dict())
+            self._folders.move_to_end(directory)
+            self._wanted = [song for song in songs if song not in folder]
+            self._condition.notify()
+
+    def resolve(self, song):
+        """
+        Gets the path to play a song from.
+
+        :return: The path of the staged copy, or the path of the song if it is not staged
+        """
+        with self._condition:
+            entry = self._folders.get(os.path.dirname(song), {}).get(song)
+        return entry[0] if entry else song
+
+    def invalidate(self, directories=None):
+        """
+        Removes the staged songs of song libraries which have changed.
+
+        :param directories: Song directories which have changed, None for all song libraries
+        """
+        with self._condition:
+            for directory in list(self._folders if directories is None else directories):
+                self._evict(directory)
+            if directories is None or self._active in directories:
+                self._active = None
+                self._wanted = list()
+
+    def _evict(self, directory):
+        """Removes all staged songs of a song library"""
+        folder = self._folders.pop(directory, None)
+        if folder is None:
+            return
+
+        logger.debug('evict staged songs of %s', directory)
+        for staged, size in folder.values():
+            self._size -= size
+            try:
+                os.remove(staged)
+            except OSError:
+                pass
+
+    def _reserve(self, directory, size):
+        """Evicts other song libraries until the song fits into the budget"""
+        while self._size + size > self._budget:
+            others = [other for other in self._folders if other != directory]
+            if not others:
+                return False
+            self._evict(others[0])
+        self._size += size
+        return True
+
+    def _run(self):
+        """Copies the wanted songs to the staging directory"""
+        while True:
+            with self._condition:
+                while self._running and not self._wanted:
+                    self._condition.wait()
+                if not self._running:
+                    return
+                song = self._wanted.pop(0)
+                directory = self._active
+                folder = self._folders.get(directory)
+
+            try:
+                size = os.stat(song).st_size
+            except OSError:
+                continue
+
+            with self._condition:
+                if not self._reserve(directory, size):
+                    logger.info('staging budget exhausted, stop staging %s', directory)
+                    self._wanted = list()
+                    continue
+
+            name = hashlib.sha1(directory.encode('utf-8')).hexdigest()[:16]
+            staged = os.path.join(self._path, name, os.path.basename(song))
+            try:
+                os.makedirs(os.path.dirname(staged), exist_ok=True)
+                shutil.copyfile(song, staged + '.part')
+                os.replace(staged + '.part', staged)
+            except OSError as ex:
+                logger.warning('can\'t stage song %s: %s', song, ex)
+                with self._condition:
+                    self._size -= size
+                continue
+
+            with self._condition:
+                if self._folders.get(directory) is not folder:
+                    # the song library has changed or was evicted while the song was copied
+                    self._size -= size
+                    os.remove(staged)
+                    continue
+                folder[song] = (staged, size)
+            logger.debug('staged song %s', song)
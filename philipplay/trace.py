@@ -0,0 +1,263 @@
+import logging
+import os
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+TRACE_MAGIC = b'PPTRACE'
+TRACE_VERSION = 1
+
+# record kinds, every record starts with the microseconds since the previous record and its kind
+STRING = 0
+KEYS = 1
+EVENT = 2
+MIXER = 3
+PLAYER = 4
+LIBRARY = 5
+LISTING = 6
+
+HEADER = struct.Struct('<7sBd')
+RECORD = struct.Struct('<IB')
+COUNT = struct.Struct('<I')
+KEY = struct.Struct('<i')
+EVENT_FIELDS = struct.Struct('<IIIB')
+MIXER_FIELDS = struct.Struct('<I')
+PLAYER_FIELDS = struct.Struct('<II')
+LENGTH = struct.Struct('<H')
+
+# the largest time between two records, longer pauses are shortened
+MAX_DELTA = 2 ** 32 - 1
+
+
+class TraceRecorder(object):
+    """
+    Records the input of the player to a compact binary trace, to replay it later (see
+    ``benchmarks/replay_trace.py``): the key presses, the file system events changing the song
+    library, the end events of the mixer, and the transitions of the player as its output.
+    The songs of the library are recorded once it was scanned, to rebuild it for the replay, and
+    the songs found whenever a song directory is listed again, as the file system events do not
+    cover every change, e.g. songs copied into a new directory before it was watched.
+
+    Strings like the paths of songs are written once and referred to by their number afterwards.
+    Recording only appends to a buffer in memory, a background thread writes the buffer to the
+    trace file at a fixed interval.
+    """
+    def __init__(self, path, interval=1.):
+        """
+        Initializes a new instance of the :class:`TraceRecorder` class.
+
+        :param str path: Path of the trace file, an existing trace is replaced
+        :param float interval: Interval in seconds to write the recorded records to the trace file
+        """
+        self._path = os.path.expanduser(path)
+        self._interval = interval
+        self._file = None
+        self._buffer = bytearray()
+        self._strings = {None: 0}
+        self._last = 0
+        self._running = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='philipplay-trace', daemon=True)
+
+    def start(self):
+        """Creates the trace file and starts the background thread"""
+        self._file = open(self._path, 'wb')
+        self._file.write(HEADER.pack(TRACE_MAGIC, TRACE_VERSION, time.time()))
+        self._last = time.perf_counter()
+        self._running = True
+        self._thread.start()
+        logger.info('record trace to %s', self._path)
+
+    def stop(self):
+        """Stops the background thread and writes the remaining records"""
+        if not self._running:
+            return
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+        self._flush()
+        self._file.close()
+
+    def keys(self, keys):
+        """
+        Records keys which were read at once.
+
+        :param list keys: Key codes
+        """
+        with self._condition:
+            self._record(KEYS, COUNT.pack(len(keys)) + struct.pack('<%si' % len(keys), *keys))
+
+    def event(self, event):
+        """
+        Records a file system event.
+
+        :param watchdog.events.FileSystemEvent event: File system event
+        """
+        with self._condition:
+            fields = EVENT_FIELDS.pack(self._string(event.event_type), self._string(str(event.src_path)),
+                                       self._string(str(getattr(event, 'dest_path', '')) or None),
+                                       event.is_directory)
+            self._record(EVENT, fields)
+
+    def mixer(self, event_type):
+        """
+        Records an end event of the mixer.
+
+        :param int event_type: Type of the pygame event, :data:`philipplay.player.NEXT_SONG` or
+            :data:`philipplay.player.STOP`
+        """
+        with self._condition:
+            self._record(MIXER, MIXER_FIELDS.pack(event_type))
+
+    def transition(self, state, song=None):
+        """
+        Records a transition of the player.
+
+        :param str state: State of the player
+        :param str song: Song which is played, None if the song did not change
+        """
+        with self._condition:
+            self._record(PLAYER, PLAYER_FIELDS.pack(self._string(state), self._string(song)))
+
+    def library(self, roots, songs):
+        """
+        Records the songs of the library.
+
+        :param list roots: Root directories of the library
+        :param list songs: Absolute paths of all songs
+        """
+        with self._condition:
+            ids = [self._string(path) for path in list(roots) + list(songs)]
+            payload = COUNT.pack(len(roots)) + COUNT.pack(len(songs)) + struct.pack('<%sI' % len(ids), *ids)
+            self._record(LIBRARY, payload)
+
+    def listing(self, directory, names):
+        """
+        Records the songs found by listing a song directory.
+
+        :param str directory: Absolute path of the song directory
+        :param list names: File names of the songs
+        """
+        with self._condition:
+            ids = [self._string(directory)] + [self._string(name) for name in names]
+            self._record(LISTING, COUNT.pack(len(names)) + struct.pack('<%sI' % len(ids), *ids))
+
+    def _string(self, value):
+        """Gets the number of a string, the string is recorded first if it is new"""
+        number = self._strings.get(value)
+        if number is None:
+            number = self._strings[value] = len(self._strings)
+            encoded = value.encode('utf-8', 'surrogateescape')
+            self._record(STRING, LENGTH.pack(len(encoded)) + encoded)
+        return number
+
+    def _record(self, kind, payload):
+        """Appends a record to the buffer"""
+        now = time.perf_counter()
+        delta = min(MAX_DELTA, max(0, int((now - self._last) * 1000000)))
+        self._last += delta / 1000000
+        self._buffer += RECORD.pack(delta, kind)
+        self._buffer += payload
+
+    def _run(self):
+        """Writes the recorded records at a fixed interval"""
+        while True:
+            with self._condition:
+                self._condition.wait(self._interval)
+                if not self._running:
+                    return
+            self._flush()
+
+    def _flush(self):
+        """Writes the recorded records to the trace file"""
+        with self._condition:
+            buffer, self._buffer = self._buffer, bytearray()
+        if buffer:
+            self._file.write(buffer)
+            self._file.flush()
+
+
+def read_trace(path):
+    """
+    Reads a trace recorded by :class:`TraceRecorder`. A record which was cut off, e.g. as the
+    player was killed while the trace was written, ends the trace.
+
+    :param str path: Path of the trace file
+    :return: Generator of tuples of the time in seconds since the start of the recording, the kind of
+        the record and its fields. The fields are a list of key codes for :data:`KEYS`, a tuple of the
+        event type, source path, destination path and directory flag for :data:`EVENT`, the event type
+        for :data:`MIXER`, a tuple of the state and song for :data:`PLAYER`, a tuple of the roots and
+        songs for :data:`LIBRARY` and a tuple of the song directory and the file names for :data:`LISTING`
+    :raises ValueError: If the file is no trace
+    """
+    with open(os.path.expanduser(path), 'rb') as trace_file:
+        data = trace_file.read()
+
+    if len(data) < HEADER.size:
+        raise ValueError('%s is no trace' % path)
+    magic, version, _ = HEADER.unpack_from(data)
+    if magic != TRACE_MAGIC or version != TRACE_VERSION:
+        raise ValueError('%s is no trace of version %s' % (path, TRACE_VERSION))
+
+    strings = [None]
+    offset = HEADER.size
+    elapsed = 0
+    while offset + RECORD.size <= len(data):
+        try:
+            offset, elapsed, record = _read_record(data, offset, elapsed, strings)
+        except struct.error:
+            logger.warning('trace %s was cut off at offset %s', path, offset)
+            return
+        if record is not None:
+            yield record
+
+
+def _read_record(data, offset, elapsed, strings):
+    """
+    Reads the record at an offset of a trace, a string is added to the strings.
+
+    :return: Tuple of the offset of the next record, the microseconds since the start of the recording
+        and the record as returned by :func:`read_trace`, None for a string
+    """
+    delta, kind = RECORD.unpack_from(data, offset)
+    offset += RECORD.size
+    elapsed += delta
+    if kind == STRING:
+        length, = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        if offset + length > len(data):
+            raise struct.error('string exceeds the trace')
+        strings.append(data[offset:offset + length].decode('utf-8', 'surrogateescape'))
+        return offset + length, elapsed, None
+
+    if kind == KEYS:
+        count, = COUNT.unpack_from(data, offset)
+        fields = list(struct.unpack_from('<%si' % count, data, offset + COUNT.size))
+        offset += COUNT.size + count * KEY.size
+    elif kind == EVENT:
+        event_type, src, dest, directory = EVENT_FIELDS.unpack_from(data, offset)
+        fields = (strings[event_type], strings[src], strings[dest], bool(directory))
+        offset += EVENT_FIELDS.size
+    elif kind == MIXER:
+        fields, = MIXER_FIELDS.unpack_from(data, offset)
+        offset += MIXER_FIELDS.size
+    elif kind == PLAYER:
+        state, song = PLAYER_FIELDS.unpack_from(data, offset)
+        fields = (strings[state], strings[song])
+        offset += PLAYER_FIELDS.size
+    elif kind == LIBRARY:
+        roots, songs = struct.unpack_from('<II', data, offset)
+        ids = struct.unpack_from('<%sI' % (roots + songs), data, offset + 2 * COUNT.size)
+        fields = ([strings[i] for i in ids[:roots]], [strings[i] for i in ids[roots:]])
+        offset += 2 * COUNT.size + (roots + songs) * COUNT.size
+    elif kind == LISTING:
+        count, = COUNT.unpack_from(data, offset)
+        ids = struct.unpack_from('<%sI' % (count + 1), data, offset + COUNT.size)
+        fields = (strings[ids[0]], [strings[i] for i in ids[1:]])
+        offset += COUNT.size + (count + 1) * COUNT.size
+    else:
+        raise ValueError('unknown record kind %s at offset %s' % (kind, offset))
+    return offset, elapsed, (elapsed / 1000000, kind, fields)
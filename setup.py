@@ -85,6 +85,8 @@ setup(
     extras_require={
         'dev': ['check-manifest'],
         'test': ['coverage'],
+        'metadata': ['mutagen'],
+        'loudness': ['numpy'],
     },
 
     # If there are data files included in your packages that need to be